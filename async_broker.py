@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+asyncio-native variant of Broker for many concurrent sessions
+
+The paho client runs on the asyncio event loop (socket reader/writer callbacks instead of loop_start), so there is
+no network thread and no thread per session. Sessions are awaited through futures keyed by sessionId:
+
+    broker = AsyncBroker()
+    await broker.connect()
+    session_id = await broker.start_asr()
+    intent = await broker.wait_for_intent(session_id, timeout=5.0)
+
+Evaluation has a single implementation, Broker.evaluation_loop, which evaluate() runs on a worker thread:
+
+python3 async_broker.py ./data/02-M/ --max-in-flight 100 --pacing max
+"""
+
+import json
+import uuid
+import asyncio
+import argparse
+import paho.mqtt.client as mqtt             # pip install paho-mqtt
+
+from audiobuffer import decode_pcm16, pcm16_view
+from audiostream import AudioStreamPublisher
+from broker import Broker
+from dispatch import TopicDispatcher
+
+
+class _AsyncioHelper:
+    '''Drives a paho client from an asyncio loop, as in paho's loop_asyncio example.'''
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # Keep alive pings and retries
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class _LoopPublisher:
+    '''client.publish for other threads, e.g. the pacing thread of AudioStreamPublisher, runs it on the event loop.'''
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+
+    def publish(self, topic, payload):
+        self.loop.call_soon_threadsafe(self.client.publish, topic, payload)
+
+
+class AsyncBroker:
+    '''Hermes session API as coroutines, all topic names are the ones of Broker.'''
+    def __init__(self, host='localhost', port=1883, site_id='default', user='', password='', audio_queue_size=8, client=None,
+                 frame_ms=30, pacing=AudioStreamPublisher.REALTIME):
+        self.host = host
+        self.port = port
+        self.site_id = site_id
+        self.user = user
+        self.password = password
+        self.client = client if client is not None else mqtt.Client()
+        self.client.username_pw_set(user, password=password)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.audio_queue_size = audio_queue_size
+        self.frame_ms = frame_ms
+        self.pacing = pacing
+
+        self.loop = None
+        self.streamer = None        # AudioStreamPublisher of send_audio(), started by connect()
+        self._connected = None
+        self._intents = {}          # sessionId -> Future of the intentParsed payload (None if not recognized)
+        self._texts = {}            # sessionId -> Future of the textCaptured payload
+        self._audio_queues = []     # (site filter, asyncio.Queue) of every running audio() iterator
+
+        self.dispatcher = TopicDispatcher()
+        self.dispatcher.register(Broker.ON_ASR_AUDIO_CAPTURED_ALL, self.__on_audio_captured, TopicDispatcher.BINARY)
+        self.dispatcher.register(Broker.ON_ASR_TEXT_CAPTURED, self.__on_text_captured)
+        self.dispatcher.register(Broker.ON_INTENT_RECOGNIZED, self.__on_intent)
+        self.dispatcher.register(Broker.ON_INTENT_NOT_RECOGNIZED, self.__on_intent)
+        self.dispatcher.register(Broker.ON_ASR_ERROR, self.__on_intent)
+
+    async def connect(self, timeout=10.0):
+        self.loop = asyncio.get_running_loop()
+        self._connected = self.loop.create_future()
+        _AsyncioHelper(self.loop, self.client)
+        if self.streamer is None:
+            self.streamer = AudioStreamPublisher(_LoopPublisher(self.loop, self.client), frame_ms=self.frame_ms,
+                                                 pacing=self.pacing)
+        # Socket callbacks must run on the loop thread, so connect is not moved to an executor
+        self.client.connect(self.host, self.port)
+        await asyncio.wait_for(self._connected, timeout)
+
+    async def disconnect(self):
+        if self.streamer is not None:
+            # Lets running streams finish, their frames are published on this loop
+            await self.loop.run_in_executor(None, self.streamer.close)
+            self.streamer = None
+        self.client.disconnect()
+        for future in [*self._intents.values(), *self._texts.values()]:
+            future.cancel()
+
+    def on_connect(self, client, userdata, flags, rc):
+        self.client.subscribe([
+            (Broker.ON_ASR_AUDIO_CAPTURED_ALL, 0),
+            (Broker.ON_ASR_TEXT_CAPTURED, 0),
+            (Broker.ON_INTENT_RECOGNIZED, 0),
+            (Broker.ON_INTENT_NOT_RECOGNIZED, 0),
+            (Broker.ON_ASR_ERROR, 0),
+        ])
+        if self._connected is not None and not self._connected.done():
+            if rc == 0:
+                self._connected.set_result(True)
+            else:
+                self._connected.set_exception(ConnectionError(f'Connection failed ({rc})'))
+
+    def on_message(self, client, userdata, msg):
+        # Runs on the event loop thread
+        self.dispatcher.dispatch(msg.topic, msg.payload)
+
+    def __on_audio_captured(self, topic, payload):
+        site_id, session_id = topic.split('/')[2:4]
+        signal = None
+        for site_filter, queue in self._audio_queues:
+            if site_filter not in ('+', site_id):
+                continue
+            if signal is None:
+                signal = decode_pcm16(payload)
+            if queue.full():
+                queue.get_nowait()      # drop the oldest utterance rather than blocking the loop
+            queue.put_nowait((site_id, session_id, signal))
+
+    def __on_text_captured(self, topic, payload):
+        future = self._texts.get(payload.get('sessionId'))
+        if future is not None and not future.done():
+            future.set_result(payload)
+
+    def __on_intent(self, topic, payload):
+        session_id = payload.get('sessionId')
+        future = self._intents.get(session_id)
+        if future is not None and not future.done():
+            future.set_result(payload if topic == Broker.ON_INTENT_RECOGNIZED else None)
+        if topic == Broker.ON_ASR_ERROR:
+            # No text will follow
+            future = self._texts.get(session_id)
+            if future is not None and not future.done():
+                future.set_result({})
+
+    @staticmethod
+    def __waiter(futures, session_id):
+        future = futures.get(session_id)
+        if future is None:
+            future = futures[session_id] = asyncio.get_running_loop().create_future()
+        return future
+
+    async def __wait(self, futures, session_id, timeout):
+        # Resolved futures stay in futures until they were awaited, so a result is never missed
+        future = self.__waiter(futures, session_id)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        finally:
+            futures.pop(session_id, None)
+
+    async def wait_for_intent(self, session_id, timeout=None):
+        '''intentParsed payload of session_id, None if the intent was not recognized. Raises asyncio.TimeoutError.'''
+        return await self.__wait(self._intents, session_id, timeout)
+
+    async def wait_for_text(self, session_id, timeout=None):
+        '''textCaptured payload of session_id. Raises asyncio.TimeoutError.'''
+        return await self.__wait(self._texts, session_id, timeout)
+
+    async def start_asr(self, session_id=None, site_id=None, send_audio_captured=True):
+        '''Opens an ASR session and returns its sessionId, waiters for its text and intent are registered before it starts.'''
+        session_id = session_id if session_id is not None else uuid.uuid4().hex
+        self.__waiter(self._texts, session_id)
+        self.__waiter(self._intents, session_id)
+        self.client.publish(Broker.ON_ASR_START_LISTENING, json.dumps({
+            'siteId': site_id or self.site_id, 'sessionId': session_id,
+            'stopOnSilence': False, 'sendAudioCaptured': send_audio_captured}))
+        return session_id
+
+    async def stop_asr(self, session_id, site_id=None):
+        self.client.publish(Broker.ON_ASR_STOP_LISTENING, json.dumps({'siteId': site_id or self.site_id, 'sessionId': session_id}))
+
+    async def send_audio(self, session_id, wavbytes, site_id=None, samplerate=16000):
+        '''Streams a 16 bit mono WAV (or raw PCM) as audioSessionFrame WAV frames of frame_ms, returns after the last frame.'''
+        done = self.loop.create_future()
+
+        def finished():
+            # Queued behind the frames on the loop, so everything was published once done resolves
+            if not done.done():
+                done.set_result(None)
+
+        self.streamer.submit(Broker.ON_AUDIO_SESSION_FRAME.format(siteId=site_id or self.site_id, sessionId=session_id),
+                             pcm16_view(wavbytes), samplerate, lambda: self.loop.call_soon_threadsafe(finished))
+        await done
+
+    async def send_message(self, text, session_id=None, timeout=None):
+        '''Publishes hermes/nlu/query, with a session_id and timeout also waits for and returns its intent.'''
+        message = {'input': text, 'siteId': self.site_id}
+        if session_id is not None:
+            message['sessionId'] = session_id
+        if session_id is None or timeout is None:
+            self.client.publish(Broker.ON_NLU_QUERY, json.dumps(message))
+            return None
+        # Registered before publishing, so an in-process answer is not missed, and popped by wait_for_intent
+        self.__waiter(self._intents, session_id)
+        self.client.publish(Broker.ON_NLU_QUERY, json.dumps(message))
+        return await self.wait_for_intent(session_id, timeout)
+
+    async def recognize(self, wavbytes, session_id=None, timeout=5.0):
+        '''Runs one utterance through ASR and NLU, returns (session_id, sentence, intent payload or None).'''
+        session_id = await self.start_asr(session_id)
+        await self.send_audio(session_id, wavbytes)
+        await self.stop_asr(session_id)
+        try:
+            sentence = (await self.wait_for_text(session_id, timeout)).get('text', '')
+            if sentence:
+                await self.send_message(sentence, session_id)
+            return session_id, sentence, await self.wait_for_intent(session_id, timeout)
+        finally:
+            self._intents.pop(session_id, None)
+
+    async def audio(self, site_id='+'):
+        '''Async iterator over (siteId, sessionId, float32 signal) of every audioCaptured of site_id ('+' for all sites).'''
+        entry = (site_id, asyncio.Queue(maxsize=self.audio_queue_size))
+        self._audio_queues.append(entry)
+        try:
+            while True:
+                yield await entry[1].get()
+        finally:
+            self._audio_queues.remove(entry)
+
+    async def evaluate(self, path='./data/', max_in_flight=100, timeout=5.0, metrics=None, **options):
+        '''Runs Broker.evaluation_loop on a worker thread with its own connection, returns its test_log and stats.
+
+        There is only one evaluation path, so paced audio frames, sessions, metrics and the result store behave as
+        with the synchronous Broker. options are passed on to evaluation_loop (frame_ms, pacing, store).
+        '''
+        def run():
+            broker = Broker(self.host, self.port, self.site_id, user=self.user, password=self.password, metrics=metrics)
+            try:
+                stats = broker.evaluation_loop(path, max_in_flight=max_in_flight, timeout=timeout, **options)
+            finally:
+                # Network thread first, Broker.on_disconnect would reconnect otherwise
+                broker.client.loop_stop()
+                broker.client.disconnect()
+                broker.audio_queue.close()
+            return broker.test_log, stats
+
+        return await asyncio.get_running_loop().run_in_executor(None, run)
+
+
+async def main(args):
+    broker = AsyncBroker(host=args.host, port=args.port)
+    results, stats = await broker.evaluate(args.path, max_in_flight=args.max_in_flight, timeout=args.timeout,
+                                           pacing=args.pacing)
+    correct = sum(intent.lower() == target.lower() for _, intent, target in results.values())
+    print(f"{stats['completed']}/{stats['files']} files, {stats['files_per_sec']:.2f} files/s, "
+          f"accuracy {correct / len(results) if results else 0.0:.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate a folder of audio files with concurrent ASR sessions')
+    parser.add_argument('path', type=str, nargs='?', default='./data/02-M/')
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('-m', '--max-in-flight', type=int, default=100,
+                        help='Maximum number of concurrent ASR sessions')
+    parser.add_argument('-t', '--timeout', type=float, default=5.0,
+                        help='Seconds to wait for text and intent of a session')
+    parser.add_argument('--pacing', type=str, default=AudioStreamPublisher.REALTIME,
+                        choices=[AudioStreamPublisher.REALTIME, AudioStreamPublisher.MAX],
+                        help='Stream audio frames in real time or as fast as possible')
+    asyncio.run(main(parser.parse_args()))
@@ -5,17 +5,238 @@
 # @AUTHOR : Marcel Rinder
 
 import os
+import json
+import zlib
+import hashlib
 import argparse
-import random
 import numpy as np
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from scipy.io import wavfile
 from scipy import signal
 from pathlib import Path
 import librosa
 from tqdm import tqdm
 
+from shards import ShardWriter
 
-def augment(input_folder, output_folder, num_samples=1000):
+
+def task_seed(filepath, index):
+    '''Seed of one (file, augmentation index) task, independent of task order and worker count.'''
+    return zlib.crc32(f'{os.path.basename(filepath)}:{index}'.encode())
+
+
+@lru_cache(maxsize=4)
+def read_source(filepath):
+    # Tasks of the same file mostly land on the same worker, so each worker decodes a file only once
+    samplerate, data = wavfile.read(filepath)
+    return samplerate, data.astype(np.int16)
+
+
+def sample_effects(rng, samplerate):
+    '''Draws a random, non-empty combination of effects and their parameters.'''
+    choices = np.zeros(3)
+    while not np.sum(choices) > 0:
+        choices = rng.randint(0, 2, 3)
+
+    params = {}
+    # Random pitch
+    if choices[0] == 1:
+        params['pitch'] = rng.random_sample() * 5
+    # Muffle effect
+    if choices[1] == 1:
+        params['cutoff'] = rng.random_sample() * 0.1
+    # Change playback speed
+    if choices[2] == 1:
+        params['target_sr'] = samplerate + rng.randint(-20000, 20000)
+    return params
+
+
+def apply_effects(audio_data, samplerate, params):
+    if 'pitch' in params:
+        audio_data = librosa.effects.pitch_shift(audio_data, sr=samplerate, n_steps=params['pitch'])
+
+    if 'cutoff' in params:
+        b, a = signal.butter(3, params['cutoff'])
+        audio_data = signal.lfilter(b, a, audio_data)
+
+    if 'target_sr' in params:
+        audio_data = librosa.resample(audio_data, orig_sr=samplerate, target_sr=params['target_sr'])
+
+    return audio_data
+
+
+CUTOFF_LEVELS = 256
+MAX_CUTOFF = 0.1
+
+
+@lru_cache(maxsize=CUTOFF_LEVELS)
+def filter_bank(level):
+    '''Butterworth coefficients for cutoff level (1..CUTOFF_LEVELS), designed once per process.'''
+    return signal.butter(3, level * MAX_CUTOFF / CUTOFF_LEVELS)
+
+
+def cutoff_level(cutoff):
+    return min(CUTOFF_LEVELS, max(1, int(round(cutoff / MAX_CUTOFF * CUTOFF_LEVELS))))
+
+
+def apply_effects_batch(original_data, samplerate, params_list):
+    '''Applies the effects of K variants of one clip together.
+
+    The STFT of the original is computed once and reused for every pitch shift (librosa's pitch_shift
+    recomputes it per call), muffle filters come from a quantized coefficient bank and are applied to the
+    stacked 2-D array of all variants sharing a cutoff level. Only the speed change, which gives every
+    variant its own length, is done per variant.
+    '''
+    length = len(original_data)
+    stack = np.repeat(original_data[np.newaxis], len(params_list), axis=0)
+
+    pitched = [k for k, params in enumerate(params_list) if 'pitch' in params]
+    if pitched:
+        stft = librosa.stft(original_data)
+        for k in pitched:
+            rate = 2.0 ** (-float(params_list[k]['pitch']) / 12)
+            stretched = librosa.istft(librosa.phase_vocoder(stft, rate=rate), dtype=original_data.dtype,
+                                      length=int(round(length / rate)))
+            shifted = librosa.resample(stretched, orig_sr=float(samplerate) / rate, target_sr=samplerate)
+            stack[k] = librosa.util.fix_length(shifted, size=length)
+
+    levels = {}
+    for k, params in enumerate(params_list):
+        if 'cutoff' in params:
+            levels.setdefault(cutoff_level(params['cutoff']), []).append(k)
+    for level, rows in levels.items():
+        b, a = filter_bank(level)
+        stack[rows] = signal.lfilter(b, a, stack[rows], axis=-1)
+
+    variants = []
+    for k, params in enumerate(params_list):
+        audio_data = stack[k]
+        if 'target_sr' in params:
+            audio_data = librosa.resample(audio_data, orig_sr=samplerate, target_sr=params['target_sr'])
+        variants.append(audio_data)
+    return variants
+
+
+def render_batch(task):
+    '''Renders the augmentation indices of filepath with the batch engine, returns a list like render().'''
+    filepath, indices = task
+    samplerate, data = read_source(filepath)
+    original_data = data.astype(np.float32, order='C') / 32768.0
+
+    params_list = [sample_effects(np.random.RandomState(task_seed(filepath, i)), samplerate) for i in indices]
+    variants = apply_effects_batch(original_data, samplerate, params_list)
+
+    name = os.path.basename(filepath)
+    return [(name.replace('.wav', f'-aug{i}.wav'), samplerate, np.array(audio_data * (12767)).astype(np.int16))
+            for i, audio_data in zip(indices, variants)]
+
+
+def render(task):
+    '''Renders augmentation index of filepath, returns (output name, samplerate, int16 data).'''
+    filepath, index = task
+    samplerate, data = read_source(filepath)
+    original_data = data.astype(np.float32, order='C') / 32768.0
+
+    rng = np.random.RandomState(task_seed(filepath, index))
+    audio_data = apply_effects(original_data, samplerate, sample_effects(rng, samplerate))
+
+    write_data = np.array(audio_data * (12767)).astype(np.int16)
+    return os.path.basename(filepath).replace('.wav', f'-aug{index}.wav'), samplerate, write_data
+
+
+def render_serial(task):
+    '''Renders the augmentation indices of filepath one variant at a time.'''
+    filepath, indices = task
+    return [render((filepath, i)) for i in indices]
+
+
+class WavSink:
+    '''Writes every clip as its own .wav file into folder.'''
+    def __init__(self, folder):
+        self.folder = folder
+
+    def write(self, name, samplerate, data):
+        wavfile.write(os.path.join(self.folder, name), samplerate, data)
+
+    def close(self):
+        pass
+
+
+class Manifest:
+    '''Maps every output of a .wav output folder to the (source hash, seed, effect parameters) it was made from.
+
+    Lets augment() skip outputs that are still current, regenerate stale ones and delete orphans.
+    '''
+    FILENAME = 'manifest.json'
+
+    def __init__(self, folder, save_every=50):
+        self.folder = folder
+        self.path = os.path.join(folder, self.FILENAME)
+        self.save_every = save_every
+        self.entries = {}
+        self._unsaved = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+
+    def is_current(self, name, entry):
+        return self.entries.get(name) == entry and os.path.exists(os.path.join(self.folder, name))
+
+    def record(self, name, entry):
+        self.entries[name] = entry
+        self._unsaved += 1
+        # Saved regularly so an interrupted run resumes close to where it stopped
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def remove_orphans(self, expected):
+        orphans = [name for name in self.entries if name not in expected]
+        for name in orphans:
+            path = os.path.join(self.folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+            del self.entries[name]
+        self.save()
+        return len(orphans)
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+
+
+def source_hash(filepath):
+    with open(filepath, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def expected_outputs(files, augments_per_file, engine):
+    '''Manifest entries of all outputs a run over files should produce, keyed by output name.'''
+    expected = {}
+    for filepath in files:
+        name = os.path.basename(filepath)
+        samplerate, _ = read_source(filepath)
+        sha = source_hash(filepath)
+        expected[name.replace('.wav', '-orig.wav')] = {'source': name, 'source_hash': sha, 'seed': None, 'params': {}, 'engine': 'orig'}
+        for i in range(augments_per_file):
+            seed = task_seed(filepath, i)
+            params = sample_effects(np.random.RandomState(seed), samplerate)
+            expected[name.replace('.wav', f'-aug{i}.wav')] = {'source': name, 'source_hash': sha, 'seed': seed, 'params': params, 'engine': engine}
+    return expected
+
+
+def write_results(sink, results, progress, on_written=None):
+    for name, samplerate, write_data in results:
+        sink.write(name, samplerate, write_data)
+        if on_written is not None:
+            on_written(name)
+        progress.update()
+
+
+def augment(input_folder, output_folder, num_samples=1000, workers=1, engine='serial', batch_size=16, output_format='wav', rebuild=False):
     # Check if input folder exists
     assert os.path.exists(input_folder), "Input folder not found"
 
@@ -24,55 +245,72 @@ def augment(input_folder, output_folder, num_samples=1000):
         os.makedirs(output_folder)
 
     # Loop through all .wav files in input folder
-    files = list(Path(input_folder).glob(*.wav'))
+    files = sorted(str(path) for path in Path(input_folder).glob('*.wav'))
     num_files = len(files)
     augments_per_file = num_samples // num_files
 
     print(f'--- Input Folder: {input_folder} ---')
     print(f'Number of audiofiles   = {num_files}')
     print(f'Augmentations per file = {augments_per_file}')
+    print(f'Workers                = {workers}')
+    print(f'Engine                 = {engine}')
+    print(f'Output format          = {output_format}')
     print()
 
-    seed = 0
-    for filepath in files:
-        print(f'--- Augmenting {filepath} ---')
-        samplerate, data = wavfile.read(filepath)
-        data = data.astype(np.int16)
-        original_data = data.astype(np.float32, order='C') / 32768.0
-
-        output_filepath = os.path.join(output_folder, os.path.basename(filepath))
-
-        # Write original audio to output folder
-        wavfile.write(output_filepath.replace('.wav', f'-orig.wav'), samplerate, data)
-
-        # Generate and apply random effects
-        for i in tqdm(range(augments_per_file)):
-            audio_data = original_data.copy()
-
-            np.random.seed(seed)
-            choices = np.zeros(3)
-            while not np.sum(choices) > 0:
-                choices = np.random.randint(0, 2, 3)
-
-            # Random pitch
-            if choices[0] == 1:
-                audio_data = librosa.effects.pitch_shift(audio_data, sr=samplerate, n_steps=np.random.random() * 5)
-
-            # Muffle effect
-            if choices[1] == 1:
-                b, a = signal.butter(3, np.random.random() * 0.1)
-                audio_data = signal.lfilter(b, a, audio_data)
-
-            # Change playback speed
-            if choices[2] == 1:
-                audio_data = librosa.resample(audio_data, orig_sr=samplerate, target_sr=samplerate + np.random.randint(-20000, 20000))
-
-            
-            # Write audio with applied effect to output folder
-            write_data = np.array(audio_data * (12767)).astype(np.int16)
-            wavfile.write(output_filepath.replace('.wav', f'-aug{i}.wav'), samplerate, write_data)
-            seed += 1
+    # Either one .wav per clip or all clips appended to packed shards (see shards.py).
+    # Shards are always rebuilt, .wav folders are updated incrementally from their manifest
+    sink = ShardWriter(output_folder) if output_format == 'shards' else WavSink(output_folder)
+    incremental = output_format == 'wav' and not rebuild
+
+    expected = expected_outputs(files, augments_per_file, engine)
+    manifest = Manifest(output_folder) if output_format == 'wav' else None
+    if incremental:
+        stale = {name for name, entry in expected.items() if not manifest.is_current(name, entry)}
+        print(f'Up to date             = {len(expected) - len(stale)}')
+        print(f'To generate            = {len(stale)}')
+        print(f'Removed orphans        = {manifest.remove_orphans(expected)}')
         print()
+    else:
+        stale = set(expected)
+        if manifest is not None:
+            manifest.remove_orphans(expected)
+    on_written = (lambda name: manifest.record(name, expected[name])) if manifest is not None else None
+
+    # Write original audio to output folder
+    for filepath in files:
+        name = os.path.basename(filepath).replace('.wav', f'-orig.wav')
+        if name in stale:
+            samplerate, data = read_source(filepath)
+            sink.write(name, samplerate, data)
+            if on_written is not None:
+                on_written(name)
+
+    # Generate and apply random effects, every variant is seeded from its own identity.
+    # A task is a file and a group of augmentation indices: one index for the serial engine,
+    # up to batch_size indices rendered together for the batch engine
+    group = batch_size if engine == 'batch' else 1
+    tasks = []
+    for filepath in files:
+        name = os.path.basename(filepath)
+        indices = [i for i in range(augments_per_file) if name.replace('.wav', f'-aug{i}.wav') in stale]
+        tasks.extend((filepath, tuple(indices[start:start + group])) for start in range(0, len(indices), group))
+    renderer = render_batch if engine == 'batch' else render_serial
+
+    try:
+        with tqdm(total=sum(len(indices) for _, indices in tasks)) as progress:
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    chunksize = max(1, len(tasks) // (workers * 4))
+                    for results in executor.map(renderer, tasks, chunksize=chunksize):
+                        write_results(sink, results, progress, on_written)
+            else:
+                for results in map(renderer, tasks):
+                    write_results(sink, results, progress, on_written)
+    finally:
+        sink.close()
+        if manifest is not None:
+            manifest.save()
+    print()
 
 
 if __name__ == '__main__':
@@ -83,9 +321,19 @@ if __name__ == '__main__':
                         help='Output folder where the augmented audio samples will be saved to')
     parser.add_argument('-n', '--num-samples', type=int,
                         help='Number of samples that will be generated')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of worker processes')
+    parser.add_argument('-e', '--engine', type=str, default='serial', choices=['serial', 'batch'],
+                        help='serial: one variant at a time, batch: K variants per clip with shared STFT and filter bank')
+    parser.add_argument('-b', '--batch-size', type=int, default=16,
+                        help='Variants per clip rendered together by the batch engine')
+    parser.add_argument('-f', '--format', type=str, default='wav', choices=['wav', 'shards'],
+                        help='wav: one file per clip, shards: packed int16 shards with an index (see shards.py)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Regenerate all outputs instead of only missing or stale ones (wav format)')
 
     args = parser.parse_args()
 
-    augment(args.input_folder, args.output_folder, num_samples=args.num_samples)
-
-
+    augment(args.input_folder, args.output_folder, num_samples=args.num_samples, workers=args.workers,
+            engine=args.engine, batch_size=args.batch_size, output_format=args.format,
+            rebuild=args.rebuild)
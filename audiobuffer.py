@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Allocation-free decoding of 16 bit PCM payloads (audioCaptured) into float32 buffers
+"""
+
+import struct
+import threading
+import numpy as np
+
+
+PCM16_SCALE = np.float32(1.0 / 32768.0)
+
+
+class BufferPool:
+    '''Bounded pool of reusable float32 buffers.
+
+    acquire() hands out a view of exactly the requested length on a pooled buffer, release() puts the
+    underlying buffer back. At most max_buffers free buffers are kept, surplus ones are left to the GC.
+    '''
+    def __init__(self, max_buffers=4, min_samples=16000 * 5):
+        self.max_buffers = max_buffers
+        self.min_samples = min_samples
+        self.allocations = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self, num_samples):
+        with self._lock:
+            for i, buf in enumerate(self._free):
+                if buf.size >= num_samples:
+                    del self._free[i]
+                    return buf[:num_samples]
+
+        # No pooled buffer large enough: grow to the next power of two so the pool settles quickly
+        size = max(self.min_samples, 1 << max(0, int(num_samples - 1).bit_length()))
+        self.allocations += 1
+        return np.empty(size, dtype=np.float32)[:num_samples]
+
+    def release(self, view):
+        buf = view.base if view.base is not None else view
+        with self._lock:
+            if len(self._free) < self.max_buffers and not any(b is buf for b in self._free):
+                self._free.append(buf)
+
+
+def wav_data_offset(payload):
+    '''Returns the byte offset of the PCM samples in payload (0 for raw PCM, the data chunk for RIFF/WAV).'''
+    mv = memoryview(payload)
+    if len(mv) < 12 or mv[0:4] != b'RIFF' or mv[8:12] != b'WAVE':
+        return 0
+
+    offset = 12
+    while offset + 8 <= len(mv):
+        chunk_id = mv[offset:offset + 4]
+        chunk_size, = struct.unpack_from('<I', mv, offset + 4)
+        if chunk_id == b'data':
+            return offset + 8
+        offset += 8 + chunk_size + (chunk_size & 1)
+    return len(mv)
+
+
+def pcm16_view(payload):
+    '''Zero-copy int16 view on the samples contained in payload.'''
+    offset = wav_data_offset(payload)
+    count = (len(payload) - offset) // 2
+    return np.frombuffer(payload, dtype='<i2', count=count, offset=offset)
+
+
+def decode_pcm16(payload, pool=None):
+    '''Converts a PCM16 (or WAV) payload to float32 in [-1, 1).
+
+    With a pool, the result is a view on a pooled buffer and must be handed back with pool.release()
+    once the consumer is done with it.
+    '''
+    pcm = pcm16_view(payload)
+    out = pool.acquire(pcm.size) if pool is not None else np.empty(pcm.size, dtype=np.float32)
+    np.multiply(pcm, PCM16_SCALE, out=out)
+    return out
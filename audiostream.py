@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Streams recorded audio over MQTT in small WAV frames, paced like a live microphone
+
+Files are decoded once to 16 kHz mono int16 PCM in cache/pcm/ and memory-mapped from there, frames are sliced
+out of the mapping. One pacing thread interleaves all active streams, so concurrent sessions share a thread.
+"""
+
+import os
+import heapq
+import struct
+import itertools
+import threading
+import time
+import numpy as np
+
+from dataset_cache import ROOT
+from embedding_cache import file_fingerprint
+
+
+PCM_ROOT = os.path.join(ROOT, 'cache', 'pcm')
+_WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+
+def wav_header(samplerate, num_samples):
+    '''44 byte header of a mono 16 bit PCM WAV file with num_samples samples.'''
+    data_size = num_samples * 2
+    return _WAV_HEADER.pack(b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, 1, samplerate, samplerate * 2, 2, 16,
+                            b'data', data_size)
+
+
+def decode_to_pcm(file, sampling_rate=16000, pcm_root=PCM_ROOT):
+    '''Memory-mapped int16 PCM of an audio file (wav, mp3, ogg), decoded and resampled only on first use.'''
+    pcm_path = os.path.join(pcm_root, f'{file_fingerprint(file)}-{sampling_rate}.pcm')
+    if not os.path.exists(pcm_path):
+        pcm = None
+        if file.endswith('.wav'):
+            from scipy.io import wavfile
+            samplerate, data = wavfile.read(file)
+            if samplerate == sampling_rate and data.dtype == np.int16 and data.ndim == 1:
+                pcm = data
+        if pcm is None:
+            import librosa
+            signal, _ = librosa.load(file, sr=sampling_rate, mono=True)
+            pcm = (np.clip(signal, -1.0, 1.0) * 32767).astype('<i2')
+
+        os.makedirs(pcm_root, exist_ok=True)
+        tmp_path = f'{pcm_path}.tmp'
+        np.ascontiguousarray(pcm, dtype='<i2').tofile(tmp_path)
+        os.replace(tmp_path, pcm_path)
+
+    if os.path.getsize(pcm_path) == 0:
+        return np.zeros(0, dtype='<i2')
+    return np.memmap(pcm_path, dtype='<i2', mode='r')
+
+
+class _Stream:
+    __slots__ = ('topic', 'pcm', 'samplerate', 'frame', 'header', 'position', 'started', 'on_done')
+
+    def __init__(self, topic, pcm, samplerate, frame, on_done):
+        self.topic = topic
+        self.pcm = pcm
+        self.samplerate = samplerate
+        self.frame = frame
+        self.header = wav_header(samplerate, frame)
+        self.position = 0
+        self.started = None
+        self.on_done = on_done
+
+
+class AudioStreamPublisher:
+    '''Publishes int16 PCM as WAV frames of frame_ms milliseconds.
+
+    pacing='realtime' sends every frame when it would have been recorded, pacing='max' as fast as possible.
+    on_done of a stream is called on the pacing thread after its last frame was published.
+    '''
+    REALTIME = 'realtime'
+    MAX = 'max'
+
+    def __init__(self, client, frame_ms=30, pacing=REALTIME):
+        if pacing not in (self.REALTIME, self.MAX):
+            raise ValueError(f'Unknown pacing: {pacing}')
+        self.client = client
+        self.frame_ms = frame_ms
+        self.pacing = pacing
+        self.frames = 0
+
+        self._heap = []             # (due time, sequence, stream)
+        self._sequence = itertools.count()
+        self._changed = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self.__run, daemon=True, name='AudioStream')
+        self._thread.start()
+
+    def submit(self, topic, pcm, samplerate=16000, on_done=None):
+        frame = max(1, samplerate * self.frame_ms // 1000)
+        stream = _Stream(topic, pcm, samplerate, frame, on_done)
+        # Same due time as the running streams with pacing='max', so the new stream joins their round robin
+        due = 0.0 if self.pacing == self.MAX else time.perf_counter()
+        with self._changed:
+            heapq.heappush(self._heap, (due, next(self._sequence), stream))
+            self._changed.notify()
+
+    @property
+    def active(self):
+        return len(self._heap)
+
+    def __run(self):
+        while True:
+            with self._changed:
+                while not self._heap and not self._closed:
+                    self._changed.wait()
+                if not self._heap:
+                    return
+                due, _, stream = self._heap[0]
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    self._changed.wait(timeout=delay)
+                    continue
+                heapq.heappop(self._heap)
+
+            if self.__publish_frame(stream):
+                with self._changed:
+                    heapq.heappush(self._heap, (self.__next_due(stream), next(self._sequence), stream))
+            elif stream.on_done is not None:
+                stream.on_done()
+
+    def __next_due(self, stream):
+        if self.pacing == self.MAX:
+            return 0.0      # round robin between streams, the sequence number orders equal due times
+        # Absolute schedule, so publish time does not accumulate as drift
+        return stream.started + stream.position / stream.samplerate
+
+    def __publish_frame(self, stream):
+        if stream.started is None:
+            stream.started = time.perf_counter()
+        start, end = stream.position, min(stream.position + stream.frame, len(stream.pcm))
+        if start >= end:
+            return False
+        header = stream.header if end - start == stream.frame else wav_header(stream.samplerate, end - start)
+        self.client.publish(stream.topic, header + stream.pcm[start:end].tobytes())
+        stream.position = end
+        self.frames += 1
+        return True
+
+    def close(self):
+        '''Lets queued streams finish and stops the pacing thread.'''
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
+        self._thread.join()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Micro-batching scheduler in front of EmotionAnalyser.predict_batch
+"""
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+
+
+class BatchScheduler:
+    '''Collects signals for up to max_latency seconds and runs them as batched model calls.
+
+    Pending signals are grouped by exact length, the model has no attention mask, so a zero padded signal
+    would get a different result than from predict(). Live utterances almost never have the same number of
+    samples, so with microphone input mean_batch_size stays near 1 and only the added max_latency remains.
+    Batching pays off for equal-length input, e.g. replayed evaluation audio cut to a fixed length.
+    Every submit() returns a Future with that signal's result.
+    '''
+    def __init__(self, analyser, max_batch_size=8, max_latency=0.02):
+        self.analyser = analyser
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self.batches = 0
+        self.items = 0
+
+        self._pending = queue.Queue()
+        self._thread = threading.Thread(target=self.__loop, name='BatchScheduler', daemon=True)
+        self._thread.start()
+
+    def submit(self, signal):
+        future = Future()
+        # Copy, the caller's buffer (e.g. from Broker.buffer_pool) is reused once it returns
+        self._pending.put((np.array(signal, dtype=np.float32), future))
+        return future
+
+    def predict(self, signal):
+        return self.submit(signal).result()
+
+    def close(self):
+        self._pending.put(None)
+        self._thread.join()
+
+    @property
+    def mean_batch_size(self):
+        return self.items / self.batches if self.batches else 0.0
+
+    def __collect(self):
+        first = self._pending.get()
+        if first is None:
+            return None
+
+        items = [first]
+        deadline = time.perf_counter() + self.max_latency
+        while len(items) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._pending.put(None)
+                break
+            items.append(item)
+        return items
+
+    def __loop(self):
+        while True:
+            items = self.__collect()
+            if items is None:
+                return
+
+            buckets = {}
+            for signal, future in items:
+                if future.set_running_or_notify_cancel():
+                    buckets.setdefault(len(signal), []).append((signal, future))
+
+            for bucket in buckets.values():
+                self.batches += 1
+                self.items += len(bucket)
+                try:
+                    results = self.analyser.predict_batch([signal for signal, _ in bucket])
+                except Exception as e:
+                    for _, future in bucket:
+                        future.set_exception(e)
+                else:
+                    for (_, future), result in zip(bucket, results):
+                        future.set_result(result)
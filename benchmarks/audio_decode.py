@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Micro-benchmark of the audioCaptured decode path: legacy copy chain vs. pooled zero-copy decode
+
+python3 benchmarks/audio_decode.py --seconds 5 --messages 200
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audiobuffer import BufferPool, decode_pcm16
+
+
+def make_payload(seconds, sampling_rate=16000):
+    rng = np.random.default_rng(0)
+    pcm = (rng.standard_normal(int(seconds * sampling_rate)) * 3000).astype('<i2')
+    return pcm.tobytes()
+
+
+def legacy_decode(payload):
+    # Former Broker.on_message: JSON attempt, np.fromstring copy, astype copy, division copy
+    try:
+        json.loads(payload.decode('UTF-8'))
+    except (UnicodeDecodeError, ValueError):
+        pass
+    pl = np.frombuffer(payload, np.int16).copy()
+    pl = pl.astype(np.float32, order='C') / 32768.0
+    return pl
+
+
+def pooled_decode(payload, pool):
+    signal = decode_pcm16(payload, pool)
+    pool.release(signal)
+    return signal
+
+
+def run(name, decode, payload, messages):
+    decode(payload)     # warm up
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_blocks = len(tracemalloc.take_snapshot().traces)
+    peak = 0
+    for _ in range(messages):
+        base, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        decode(payload)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    retained_blocks = len(tracemalloc.take_snapshot().traces) - start_blocks
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        decode(payload)
+    elapsed = time.perf_counter() - start
+
+    print(f'{name:8s} {len(payload) * messages / elapsed / 1e6:10.1f} MB/s '
+          f'{elapsed / messages * 1e6:10.1f} us/msg '
+          f'{peak / 1024:10.1f} KiB peak alloc/msg '
+          f'{retained_blocks:6d} blocks retained')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark audioCaptured decoding')
+    parser.add_argument('-s', '--seconds', type=float, default=5.0,
+                        help='Length of the simulated utterance in seconds')
+    parser.add_argument('-n', '--messages', type=int, default=200,
+                        help='Number of decoded messages per variant')
+    args = parser.parse_args()
+
+    payload = make_payload(args.seconds)
+    pool = BufferPool()
+
+    print(f'Payload: {len(payload) / 1024:.0f} KiB, {args.messages} messages')
+    run('legacy', legacy_decode, payload, args.messages)
+    run('pooled', lambda p: pooled_decode(p, pool), payload, args.messages)
+    print(f'Pool allocations: {pool.allocations}')
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 06/22/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Throughput of the serial and the batch augmentation engine in augmented seconds of audio per CPU-second
+
+python3 benchmarks/augment_throughput.py -i data/02-M/ -k 16
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from pathlib import Path
+from scipy.io import wavfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audioaugment import apply_effects, apply_effects_batch, sample_effects, task_seed
+
+
+def load_clips(input_folder, seconds, samplerate=44100):
+    if input_folder:
+        clips = []
+        for path in sorted(Path(input_folder).glob('*.wav'))[:4]:
+            sr, data = wavfile.read(path)
+            clips.append((str(path), sr, data.astype(np.float32) / 32768.0))
+        return clips
+
+    rng = np.random.default_rng(0)
+    return [('synthetic.wav', samplerate, (rng.standard_normal(int(seconds * samplerate)) * 0.1).astype(np.float32))]
+
+
+def run(engine, clips, k):
+    cpu = time.process_time()
+    produced = 0.0
+    for name, samplerate, data in clips:
+        params_list = [sample_effects(np.random.RandomState(task_seed(name, i)), samplerate) for i in range(k)]
+        if engine == 'batch':
+            variants = apply_effects_batch(data, samplerate, params_list)
+        else:
+            variants = [apply_effects(data, samplerate, params) for params in params_list]
+        produced += sum(len(v) for v in variants) / samplerate
+    return produced, time.process_time() - cpu
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark augmentation engines')
+    parser.add_argument('-i', '--input-folder', type=str, default=None,
+                        help='Folder with source .wav files (first 4 are used), synthetic noise if omitted')
+    parser.add_argument('-s', '--seconds', type=float, default=2.0,
+                        help='Length of the synthetic clip in seconds')
+    parser.add_argument('-k', '--variants', type=int, default=16,
+                        help='Variants generated per clip')
+    args = parser.parse_args()
+
+    clips = load_clips(args.input_folder, args.seconds)
+    run('serial', clips[:1], 1)     # warm up librosa/numba
+
+    print(f'--- {len(clips)} clip(s), {args.variants} variants each ---')
+    results = {}
+    for engine in ('serial', 'batch'):
+        produced, cpu = run(engine, clips, args.variants)
+        results[engine] = produced / cpu
+        print(f'{engine:6s} {produced:8.1f} s audio in {cpu:6.2f} CPU-s  ->  {results[engine]:8.1f} s/CPU-s')
+    print(f'Speedup: {results["batch"] / results["serial"]:.2f}x')
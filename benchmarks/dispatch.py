@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Messages/sec of Broker.on_message routing: former if/elif chain vs. TopicDispatcher
+
+Both variants route a realistic mix of Hermes messages to the same no-op handlers, so only topic matching
+and payload decoding are measured.
+
+python3 benchmarks/dispatch.py --messages 200000
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker import Broker
+from dispatch import TopicDispatcher
+
+
+def make_messages(audio_seconds=3.0):
+    audio = (np.random.default_rng(0).standard_normal(int(audio_seconds * 16000)) * 3000).astype('<i2').tobytes()
+    frame = audio[:512 * 2]
+    parsed = json.dumps({'input': 'sit', 'intent': {'intentName': 'Sit', 'confidenceScore': 1.0},
+                         'siteId': 'default', 'sessionId': 'abc', 'slots': []}).encode()
+    mix = [
+        ('hermes/audioServer/default/audioFrame', frame, 20),
+        ('hermes/asr/startListening', json.dumps({'siteId': 'default', 'sessionId': 'abc'}).encode(), 1),
+        ('hermes/asr/textCaptured', json.dumps({'text': 'sit', 'siteId': 'default', 'sessionId': 'abc'}).encode(), 1),
+        ('hermes/nlu/intentParsed', parsed, 1),
+        ('hermes/intent/Sit', parsed, 1),
+        ('rhasspy/asr/default/0/audioCaptured', audio, 1),
+        ('hermes/tts/sayFinished', json.dumps({'siteId': 'default', 'id': '1'}).encode(), 1),
+        ('hermes/audioServer/default/playFinished', json.dumps({'siteId': 'default', 'id': '1'}).encode(), 1),
+    ]
+    return [types.SimpleNamespace(topic=topic, payload=payload) for topic, payload, weight in mix for _ in range(weight)]
+
+
+class Handlers:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+
+
+def legacy_on_message(msg, h):
+    # Former Broker.on_message with every branch calling h
+    payload = {}
+    topic = str(msg.topic).strip()
+
+    if topic.endswith('/audioCaptured'):
+        h(msg.payload)
+        return
+
+    if topic.endswith('/audioFrame'):
+        h(topic.split('/')[2], msg.payload)
+        return
+
+    if hasattr(msg, 'payload') and msg.payload:
+        try:
+            payload = json.loads(msg.payload.decode('UTF-8'))
+        except UnicodeDecodeError:
+            pass
+
+    if isinstance(payload, dict):
+        if msg.topic == Broker.ON_ASR_START_LISTENING:
+            h(payload.get('siteId', 'default'), payload.get('sessionId'))
+        elif msg.topic in (Broker.ON_ASR_STOP_LISTENING, Broker.ON_ASR_TEXT_CAPTURED):
+            h(payload.get('siteId', 'default'))
+
+    session = None
+
+    if session is not None and msg.topic in (Broker.ON_INTENT_RECOGNIZED, Broker.ON_INTENT_NOT_RECOGNIZED, Broker.ON_ASR_ERROR):
+        h(session)
+    elif msg.topic == Broker.ON_INTENT_RECOGNIZED:
+        h(payload['intent']['intentName'])
+    elif msg.topic == Broker.ON_INTENT_NOT_RECOGNIZED:
+        h()
+    elif msg.topic == Broker.ON_ASR_TEXT_CAPTURED:
+        h(payload['text'])
+    elif "hermes/hotword/default/detected" in topic:
+        h()
+    elif "hermes/intent/" in topic:
+        h()
+
+
+def make_dispatcher(h):
+    # Same registrations as Broker.__register_handlers with an emotion stream
+    dispatcher = TopicDispatcher()
+    dispatcher.register('rhasspy/asr/+/+/audioCaptured', h, TopicDispatcher.BINARY)
+    dispatcher.register(Broker.ON_AUDIO_FRAMES, h, TopicDispatcher.BINARY)
+    dispatcher.register(Broker.ON_ASR_START_LISTENING, h)
+    dispatcher.register(Broker.ON_ASR_STOP_LISTENING, h)
+    dispatcher.register(Broker.ON_ASR_TEXT_CAPTURED, h)
+    dispatcher.register(Broker.ON_INTENT_RECOGNIZED, h)
+    dispatcher.register(Broker.ON_INTENT_NOT_RECOGNIZED, h)
+    dispatcher.register(Broker.ON_ASR_ERROR, h)
+    dispatcher.register(Broker.ON_ASR_TEXT_CAPTURED, h)
+    dispatcher.register('hermes/hotword/default/detected', h, TopicDispatcher.NONE)
+    dispatcher.register(Broker.ON_INTENT_DETECTED, h, TopicDispatcher.NONE)
+    return dispatcher
+
+
+def run(name, on_message, messages, total):
+    for msg in messages:       # warm up
+        on_message(msg)
+
+    start = time.perf_counter()
+    for i in range(total):
+        on_message(messages[i % len(messages)])
+    elapsed = time.perf_counter() - start
+    print(f'{name:10s} {total / elapsed:12.0f} msg/s {elapsed / total * 1e6:8.2f} us/msg')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark MQTT message dispatch')
+    parser.add_argument('-n', '--messages', type=int, default=200000,
+                        help='Number of dispatched messages per variant')
+    args = parser.parse_args()
+
+    messages = make_messages()
+    print(f'{len(messages)} message mix, {args.messages} messages per variant')
+
+    legacy = Handlers()
+    run('legacy', lambda msg: legacy_on_message(msg, legacy), messages, args.messages)
+
+    trie = Handlers()
+    dispatcher = make_dispatcher(trie)
+    run('dispatcher', lambda msg: dispatcher.dispatch(msg.topic, msg.payload), messages, args.messages)
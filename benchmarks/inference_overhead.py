@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Per-call overhead of the audinterface path vs. the direct ndarray path of EmotionAnalyser
+
+python3 benchmarks/inference_overhead.py --seconds 1 --calls 50
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sentiment import EmotionAnalyser
+
+
+def timed(func, calls):
+    func()      # warm up
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark EmotionAnalyser inference paths')
+    parser.add_argument('-s', '--seconds', type=float, default=1.0,
+                        help='Length of the test signal in seconds')
+    parser.add_argument('-n', '--calls', type=int, default=50,
+                        help='Number of calls per path')
+    parser.add_argument('-r', '--sampling-rate', type=int, default=16000,
+                        help='Sampling rate of the test signal (resampled to 16 kHz)')
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    ea = EmotionAnalyser(categorial_output=True, show_confidence=True, warmup=True)
+    signal = (np.random.default_rng(0).standard_normal(int(args.seconds * args.sampling_rate)) * 0.05).astype(np.float32)
+
+    paths = {
+        'audinterface': lambda: ea.interface.process_signal(signal, sampling_rate=args.sampling_rate),
+        'direct': lambda: ea.features(signal, sampling_rate=args.sampling_rate),
+    }
+    results = {name: timed(func, args.calls) for name, func in paths.items()}
+
+    print(f'--- {args.seconds:.1f} s signal at {args.sampling_rate} Hz, {args.calls} calls ---')
+    for name, latencies in results.items():
+        print(f'{name:12s} mean {latencies.mean():8.2f} ms   p50 {np.percentile(latencies, 50):8.2f} ms   p95 {np.percentile(latencies, 95):8.2f} ms')
+    overhead = results['audinterface'].mean() - results['direct'].mean()
+    print(f'Framework overhead per call: {overhead:.2f} ms ({overhead / results["audinterface"].mean() * 100:.1f} %)')
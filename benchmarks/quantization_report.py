@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Compares the fp32 and the int8 quantized emotion model on a directory of WAVs:
+latency per file, peak memory and categorical agreement
+
+python3 benchmarks/quantization_report.py -i data/02-M/
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import resource
+import multiprocessing as mp
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def run_variant(quantized, files, results):
+    # Separate process per variant so that peak RSS is attributable to one model
+    from sentiment import EmotionAnalyser
+
+    os.chdir(ROOT)
+    start = time.perf_counter()
+    ea = EmotionAnalyser(categorial_output=True, show_confidence=False, quantized=quantized, warmup=True)
+    load_time = time.perf_counter() - start
+
+    predictions, latencies = [], []
+    for file in files:
+        start = time.perf_counter()
+        predictions.append(str(ea.predict(file=file)))
+        latencies.append(time.perf_counter() - start)
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024   # kB on Linux
+    results.put((quantized, load_time, predictions, latencies, max_rss))
+
+
+def measure(quantized, files):
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=run_variant, args=(quantized, files, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy/latency report for the int8 emotion model')
+    parser.add_argument('-i', '--input-folder', type=str, default='data/02-M/',
+                        help='Folder containing the .wav files to compare on')
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(os.path.abspath(args.input_folder), '*.wav')))
+    assert files, 'No .wav files found'
+
+    reports = {}
+    for quantized in (False, True):
+        _, load_time, predictions, latencies, max_rss = measure(quantized, files)
+        reports['int8' if quantized else 'fp32'] = (load_time, predictions, np.array(latencies[1:] or latencies), max_rss)
+
+    print(f'--- {len(files)} files from {args.input_folder} ---')
+    print(f'{"model":6s} {"load s":>8s} {"mean ms":>8s} {"p50 ms":>8s} {"p95 ms":>8s} {"peak MiB":>9s}')
+    for name, (load_time, _, latencies, max_rss) in reports.items():
+        print(f'{name:6s} {load_time:8.2f} {latencies.mean() * 1000:8.1f} {np.percentile(latencies, 50) * 1000:8.1f} '
+              f'{np.percentile(latencies, 95) * 1000:8.1f} {max_rss / 2 ** 20:9.0f}')
+
+    fp32, int8 = reports['fp32'][1], reports['int8'][1]
+    agreement = np.mean([a == b for a, b in zip(fp32, int8)])
+    speedup = reports['fp32'][2].mean() / reports['int8'][2].mean()
+    print(f'\nCategorical agreement: {agreement * 100:.1f} %, speedup: {speedup:.2f}x')
+    for file, a, b in zip(files, fp32, int8):
+        if a != b:
+            print(f'  {os.path.basename(file)}: fp32={a} int8={b}')
@@ -10,9 +10,19 @@ import os
 import json
 import time
 import wave
+import hashlib
+from collections import deque
 import paho.mqtt.client as mqtt             # pip install paho-mqtt
 import numpy as np
 
+from audiobuffer import BufferPool, decode_pcm16
+from workqueue import WorkQueue
+from dispatch import TopicDispatcher
+from shards import ShardDataset, is_shard_folder
+from audiostream import AudioStreamPublisher, decode_to_pcm
+from eval_store import audio_hash, model_fingerprint
+from sessions import SessionManager
+
 
 class Broker:
     ALL_SITE_ID                = 'all'
@@ -25,23 +35,33 @@ class Broker:
     ON_ASR_STOP_LISTENING      = 'hermes/asr/stopListening'
     ON_ASR_ERROR               = 'hermes/error/asr'
     ON_ASR_AUDIO_CAPTURED      = 'rhasspy/asr/{siteId}/{sessionId}/audioCaptured'
+    ON_ASR_AUDIO_CAPTURED_ALL  = 'rhasspy/asr/+/+/audioCaptured'
     ON_HOTWORD_TOGGLE_ON       = 'hermes/hotword/toggleOn'
     ON_INTENT_NOT_RECOGNIZED   = 'hermes/nlu/intentNotRecognized'
     ON_INTENT_RECOGNIZED       = 'hermes/nlu/intentParsed'
+    ON_NLU_QUERY               = 'hermes/nlu/query'
+    ON_INTENT                  = 'hermes/intent/{intentName}'
     ON_AUDIO_PLAY              = 'hermes/audioServer/{siteId}/playBytes/{requestId}'
     ON_AUDIO_PLAY_FINISHED     = 'hermes/audioServer/{siteId}/playFinished'
+    ON_AUDIO_FRAME             = 'hermes/audioServer/{siteId}/audioFrame'
+    ON_AUDIO_FRAMES            = 'hermes/audioServer/+/audioFrame'
+    ON_AUDIO_SESSION_FRAME     = 'hermes/audioServer/{siteId}/{sessionId}/audioSessionFrame'
     ON_VOLUME_SET              = 'hermes/volume/set'
 
 
-    def __init__(self, host='localhost', port=1883, site_id='default', audio_callback=None, user='', password='') -> None:
+    def __init__(self, host='localhost', port=1883, site_id='default', audio_callback=None, user='', password='',
+                 workers=1, queue_size=8, overflow=WorkQueue.DROP_OLDEST, emotion_stream=None, fast_classifier=None,
+                 exact_index=None, intent_memo=None, session_timeout=30.0, client=None,
+                 metrics=None) -> None:
         self.connected = False
         self.user = user
         self.host = host
         self.port = port
         self.site_id = site_id
         self.request_id = 'request-1'
-        self.session_id = 0
-        self.client = mqtt.Client()
+        self.session_id = 0             # number of the next live session
+        # client can be an in-process stand-in for paho (see replay.FakeMQTTClient)
+        self.client = client if client is not None else mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
@@ -49,16 +69,44 @@ class Broker:
         self.client.username_pw_set(user, password=password)
         self.client.connect(host, port)
 
-        self.current_file = ""
-        self.current_sentence = ""
-        self.current_intent = ""
-        self.target_intent = ""
-        self.intent_received = False
-        self.is_recording = False
+        # Optional metrics.Metrics, traces every session through hotword -> ... -> intentParsed -> emotion
+        self.metrics = metrics
+
+        # Live and evaluation sessions of all sites, keyed by (siteId, sessionId)
+        self.sessions = SessionManager()
+        self.session_timeout = session_timeout
 
         self.test_log = {}
         self.audio_callback = audio_callback
 
+        # audio_callback runs on worker threads so inference never blocks the paho network loop
+        self.buffer_pool = BufferPool(max_buffers=queue_size + workers)
+        self.audio_queue = WorkQueue(self.__process_audio, workers=workers, maxsize=queue_size, overflow=overflow,
+                                     on_drop=self.__drop_audio, name='AudioWorker')
+
+        # Optional StreamingEmotionEstimator fed with audioFrames while an ASR session is open
+        self.emotion_stream = emotion_stream
+        if self.emotion_stream is not None:
+            self.emotion_stream.client = self.client
+
+        # Optional FastIntentClassifier answering confident queries in-process instead of via Rasa
+        self.fast_classifier = fast_classifier
+        self.fast_hits = 0
+        self.fast_misses = 0
+        self.fast_latencies = deque(maxlen=10000)
+
+        # Optional ExactMatchIndex of training sentences and IntentMemo of results seen on the bus (see nlu_cache.py)
+        self.exact_index = exact_index
+        self.intent_memo = intent_memo
+        self.exact_hits = 0
+        self.memo_hits = 0
+        self.lookup_misses = 0
+
+        # Topic -> handlers, payloads are decoded only for handlers that need them
+        self.dispatcher = TopicDispatcher()
+        self.extra_subscriptions = []
+        self.__register_handlers()
+
 
     def on_connect(self, client, userdata, flags, rc):
         time.sleep(0.1)
@@ -68,7 +116,7 @@ class Broker:
 			(self.ON_TTS_SAY, 0),
 			(self.ON_ASR_TEXT_CAPTURED, 0),
 			(self.ON_ASR_START_LISTENING, 0),
-            (self.ON_ASR_AUDIO_CAPTURED.format(siteId=self.site_id, sessionId=self.session_id), 0),
+            (self.ON_ASR_AUDIO_CAPTURED_ALL, 0),
             (self.ON_ASR_ERROR, 0),
 			(self.ON_AUDIO_PLAY_FINISHED.format(siteId=self.site_id), 0),
 			(self.ON_TTS_SAY_FINISHED, 0),
@@ -76,6 +124,10 @@ class Broker:
 			(self.ON_INTENT_RECOGNIZED, 0),
 			# (self.ON_VOLUME_SET, 0),
 		])
+        if self.emotion_stream is not None:
+            self.client.subscribe([(self.ON_AUDIO_FRAMES, 0), (self.ON_ASR_STOP_LISTENING, 0)])
+        if self.extra_subscriptions:
+            self.client.subscribe([(topic, 0) for topic in self.extra_subscriptions])
         
         if rc == 0:
             print('Connection succeeded')
@@ -88,63 +140,230 @@ class Broker:
         '''Called when disconnected from MQTT broker.'''
         client.reconnect()
 
+    def __register_handlers(self):
+        dispatcher = self.dispatcher
+        # Binary audio payloads never go through the JSON decoder
+        dispatcher.register(self.ON_ASR_AUDIO_CAPTURED_ALL, self.__on_audio_captured, TopicDispatcher.BINARY)
+
+        if self.emotion_stream is not None:
+            dispatcher.register(self.ON_AUDIO_FRAMES, self.__on_audio_frame, TopicDispatcher.BINARY)
+            dispatcher.register(self.ON_ASR_START_LISTENING, self.__on_emotion_start)
+            dispatcher.register(self.ON_ASR_STOP_LISTENING, self.__on_emotion_finish)
+            dispatcher.register(self.ON_ASR_TEXT_CAPTURED, self.__on_emotion_finish)
+
+        if self.intent_memo is not None:
+            dispatcher.register(self.ON_INTENT_RECOGNIZED, self.__on_memo_intent)
+
+        dispatcher.register(self.ON_INTENT_RECOGNIZED, self.__on_intent_recognized)
+        dispatcher.register(self.ON_INTENT_NOT_RECOGNIZED, self.__on_intent_not_recognized)
+        dispatcher.register(self.ON_ASR_ERROR, self.__on_asr_error)
+        dispatcher.register(self.ON_ASR_TEXT_CAPTURED, self.__on_text_captured)
+        dispatcher.register(self.ON_HOTWORD_DETECTED, lambda topic, payload: self.start_asr(payload.get('siteId'), time.perf_counter()))
+        dispatcher.register(self.ON_INTENT_DETECTED, self.__on_intent)
+
+    def register_handler(self, topic_filter, handler, payload=TopicDispatcher.JSON):
+        '''Calls handler(topic, payload) for messages on topic_filter, payload is decoded as declared (see dispatch.py).'''
+        self.dispatcher.register(topic_filter, handler, payload)
+        self.extra_subscriptions.append(topic_filter)
+        if self.connected:
+            self.client.subscribe(topic_filter)
+
     def on_message(self, client, userdata, msg: mqtt.MQTTMessage):
         '''Called each time a message is received on a subscribed topic.'''
-        payload = {}
-        topic = str(msg.topic).strip()
-
-        if hasattr(msg, 'payload') and msg.payload:
-            try:
-                # siteId = payload.get('siteId')
-                # is_for_me = siteId == self.site_id
-
-                # if not is_for_me:
-                #    print('Message received but was not for me')
-                #    return False
-
-                payload = json.loads(msg.payload.decode('UTF-8'))
-
-            except UnicodeDecodeError:
-                # Payload contains audio data
-                pass
-                # payload = np.fromstring(msg.payload, np.int16)
-                # payload = payload.astype(np.float32, order='C') / 32768.0
-                # if callable(self.audio_callback):
-                #     self.audio_callback(payload)
-                
-
-        if msg.topic == self.ON_INTENT_RECOGNIZED:
-            self.current_intent = payload['intent']['intentName']
-            self.intent_received = True
-
-            if self.target_intent is not None:
-                print('Target: \t', self.target_intent)
-            print('Predicted:\t', self.current_intent)
-
-            if self.target_intent is not None:
-                self.test_log[self.current_file] = (self.current_sentence, self.current_intent, self.target_intent)
-                
-        elif msg.topic == self.ON_INTENT_NOT_RECOGNIZED:
-            print('Error: intent not recognized')
-            self.intent_received = True
-
-        elif msg.topic == self.ON_ASR_TEXT_CAPTURED:
-            self.current_sentence = payload['text']
-            print('Recognized:\t', self.current_sentence)
-
-            self.client.publish('hermes/nlu/query', json.dumps({'input': self.current_sentence, 'siteId': self.site_id}))
-
-        elif "hermes/hotword/default/detected" in topic:
-            self.start_asr()
-
-        elif "hermes/intent/" in topic:
-            self.stop_asr()
-
-        elif "audioCaptured" in topic:
-            pl = np.fromstring(msg.payload, np.int16)
-            pl = pl.astype(np.float32, order='C') / 32768.0
-            if callable(self.audio_callback):
-                self.audio_callback(pl)
+        self.dispatcher.dispatch(msg.topic, msg.payload)
+
+    def __on_audio_captured(self, topic, payload):
+        # rhasspy/asr/<siteId>/<sessionId>/audioCaptured
+        levels = topic.split('/')
+        self.on_audio_captured(payload, levels[2], levels[3])
+
+    def __trace(self, site_id, session_id, event):
+        if self.metrics is not None and session_id is not None:
+            self.metrics.mark(site_id or self.site_id, session_id, event)
+
+    def __trace_end(self, site_id, session_id, event):
+        # Result of a session (intent, not recognized, ASR error, timeout), a later emotion still joins its span
+        if self.metrics is not None and session_id is not None:
+            self.metrics.mark(site_id or self.site_id, session_id, event)
+            self.metrics.end(site_id or self.site_id, session_id)
+
+    def __on_audio_frame(self, topic, payload):
+        self.emotion_stream.feed(topic.split('/')[2], payload)
+
+    def __on_emotion_start(self, topic, payload):
+        self.emotion_stream.start(payload.get('siteId', 'default'), payload.get('sessionId'))
+
+    def __on_emotion_finish(self, topic, payload):
+        self.emotion_stream.finish(payload.get('siteId', 'default'))
+
+    def __on_memo_intent(self, topic, payload):
+        if payload.get('input'):
+            intent = payload['intent']
+            self.intent_memo.put(payload['input'], intent['intentName'], intent.get('confidenceScore'))
+
+    def __session(self, payload):
+        return self.sessions.get(payload.get('siteId', self.site_id), payload.get('sessionId'))
+
+    def __on_intent_recognized(self, topic, payload):
+        if self.metrics is not None:
+            self.__trace_end(payload.get('siteId'), payload.get('sessionId'), 'intent_parsed')
+            self.metrics.inc('enamour_intents_total', intent=payload['intent']['intentName'])
+        session = self.__session(payload)
+        if session is not None and session.file is not None:
+            session.intent = payload['intent']['intentName']
+            self.__finish_eval_session(session)
+            return
+
+        if session is not None:
+            session.intent = payload['intent']['intentName']
+        print('Predicted:\t', payload['intent']['intentName'])
+
+    def __on_intent_not_recognized(self, topic, payload):
+        if self.metrics is not None:
+            self.__trace_end(payload.get('siteId'), payload.get('sessionId'), 'intent_not_recognized')
+            self.metrics.inc('enamour_intent_not_recognized_total')
+        session = self.__session(payload)
+        if session is not None and session.file is not None:
+            self.__finish_eval_session(session)
+            return
+
+        print('Error: intent not recognized')
+        if session is not None:
+            self.stop_asr(session.site_id, session.session_id)
+
+    def __on_asr_error(self, topic, payload):
+        self.__trace_end(payload.get('siteId'), payload.get('sessionId'), 'asr_error')
+        session = self.__session(payload)
+        if session is not None and session.file is not None:
+            session.error = 'asr'
+            self.__finish_eval_session(session)
+        elif session is not None:
+            self.stop_asr(session.site_id, session.session_id)
+
+    def __on_text_captured(self, topic, payload):
+        self.__trace(payload.get('siteId'), payload.get('sessionId'), 'text_captured')
+        session = self.__session(payload)
+        if session is not None and session.file is not None:
+            session.sentence = payload['text']
+            self.query_intent(session.sentence, session.session_id, session.site_id)
+            return
+
+        print('Recognized:\t', payload['text'])
+        if session is None:
+            self.query_intent(payload['text'], payload.get('sessionId'), payload.get('siteId'))
+        else:
+            session.sentence = payload['text']
+            self.query_intent(session.sentence, session.session_id, session.site_id)
+
+    def __on_intent(self, topic, payload):
+        # hermes/intent/<name> ends a live session, evaluation sessions end on intentParsed
+        session = self.__session(payload)
+        if session is not None and session.file is None:
+            self.stop_asr(session.site_id, session.session_id)
+
+    def publish_intent(self, text, intent, confidence, session_id=None, site_id=None):
+        '''Publishes an NLU result the way Rhasspy's NLU service does (intentParsed and hermes/intent/<name>).'''
+        message = json.dumps({
+            'input': text,
+            'intent': {'intentName': intent, 'confidenceScore': confidence},
+            'siteId': site_id or self.site_id,
+            'sessionId': session_id,
+            'slots': [],
+        })
+        self.client.publish(self.ON_INTENT_RECOGNIZED, message)
+        self.client.publish(self.ON_INTENT.format(intentName=intent), message)
+
+    def query_intent(self, text, session_id=None, site_id=None):
+        '''Resolves text to an intent: exact training sentence, recently seen query, confident fast path, otherwise hermes/nlu/query.'''
+        self.__trace(site_id, session_id, 'nlu_query')
+        if self.exact_index is not None or self.intent_memo is not None:
+            intent = self.exact_index.lookup(text) if self.exact_index is not None else None
+            if intent is not None:
+                self.exact_hits += 1
+                self.publish_intent(text, intent, 1.0, session_id, site_id)
+                return
+            result = self.intent_memo.get(text) if self.intent_memo is not None else None
+            if result is not None:
+                self.memo_hits += 1
+                self.publish_intent(text, *result, session_id, site_id)
+                return
+            self.lookup_misses += 1
+
+        if self.fast_classifier is not None:
+            start = time.perf_counter()
+            intent, confidence = self.fast_classifier.predict(text)
+            self.fast_latencies.append(time.perf_counter() - start)
+            if intent is not None:
+                self.fast_hits += 1
+                self.publish_intent(text, intent, confidence, session_id, site_id)
+                return
+            self.fast_misses += 1
+
+        message = {'input': text, 'siteId': site_id or self.site_id}
+        if session_id is not None:
+            message['sessionId'] = session_id
+        self.client.publish(self.ON_NLU_QUERY, json.dumps(message))
+
+    def fast_path_stats(self):
+        '''Hit rate and latency of the in-process fast path.'''
+        total = self.fast_hits + self.fast_misses
+        return {
+            'fast_path_hit_rate': self.fast_hits / total if total else None,
+            'fast_path_latency_p50': float(np.percentile(self.fast_latencies, 50)) if self.fast_latencies else None,
+            'fast_path_latency_p95': float(np.percentile(self.fast_latencies, 95)) if self.fast_latencies else None,
+        }
+
+    def nlu_paths(self):
+        '''Settings of the in-process NLU paths that answer before Rasa, {} if every query goes to Rasa.'''
+        paths = {}
+        if self.exact_index is not None:
+            paths['exact_index'] = hashlib.sha1(json.dumps(sorted(self.exact_index.index.items())).encode()).hexdigest()
+        if self.intent_memo is not None:
+            paths['intent_memo'] = {'max_items': self.intent_memo.max_items, 'ttl': self.intent_memo.ttl}
+        if self.fast_classifier is not None:
+            classifier = self.fast_classifier
+            paths['fast_classifier'] = {'min_n': classifier.min_n, 'max_n': classifier.max_n,
+                                        'threshold': classifier.threshold, 'margin': classifier.margin}
+        return paths
+
+    def lookup_stats(self):
+        '''Hit/miss counters of the exact-match index and the intent memo.'''
+        total = self.exact_hits + self.memo_hits + self.lookup_misses
+        return {
+            'exact_hits': self.exact_hits,
+            'memo_hits': self.memo_hits,
+            'lookup_misses': self.lookup_misses,
+            'lookup_hit_rate': (self.exact_hits + self.memo_hits) / total if total else None,
+        }
+
+    def on_audio_captured(self, payload, site_id=None, session_id=None):
+        '''Decodes a PCM16/WAV payload into a pooled float32 buffer and queues it for audio_callback.
+
+        The buffer is returned to the pool after the callback, so callbacks must copy the signal if they keep it.
+        '''
+        if not payload or not callable(self.audio_callback):
+            return
+
+        if not self.audio_queue.put((decode_pcm16(payload, self.buffer_pool), site_id, session_id)):
+            print('Audio queue full - dropped utterance')
+
+    def __drop_audio(self, item):
+        self.buffer_pool.release(item[0])
+        if self.metrics is not None:
+            self.metrics.inc('enamour_audio_dropped_total')
+
+    def __process_audio(self, item):
+        # Runs on an AudioWorker thread, the callback publishes its result itself (e.g. send_message)
+        signal, site_id, session_id = item
+        try:
+            self.audio_callback(signal)
+        finally:
+            self.buffer_pool.release(signal)
+        self.__trace(site_id, session_id, 'emotion')
+
+    def queue_stats(self):
+        '''Depth and drop counters of the audio work queue.'''
+        return self.audio_queue.stats()
 
     def __loop_start(self):
         self.client.loop_start()
@@ -153,36 +372,133 @@ class Broker:
             print('Waiting for connection...')
             time.sleep(0.1)
 
-    def evaluation_loop(self, path='./data/', chunksize=1000000):
-        self.__loop_start()
-        
-        time.sleep(0.1)
-        for i, file in enumerate(os.listdir(path)):
-            # self.session_id = f'session{i}'
-
-            if file.endswith('.mp3') or file.endswith('.wav') or file.endswith('.ogg'):
-                self.target_intent = file.split('-')[1]
-
-                self.current_file = os.path.join(path, file)
-                with open(self.current_file, 'rb') as f:
-                    print("\nTesting:\t", self.current_file)
-                    wavbytes = f.read()
-
-                    self.client.publish(self.ON_ASR_START_LISTENING, json.dumps({'siteId': self.site_id, 'sessionId': self.session_id, 'stopOnSilence': False, 'sendAudioCaptured': True}))
-                    time.sleep(0.1)
+    def __finish_eval_session(self, session):
+        # test_log is written before finish() wakes evaluation_loop, under the lock so an expiry cannot interleave
+        with self.sessions.changed:
+            if self.sessions.get(session.site_id, session.session_id) is not session:
+                return
 
-                    self.client.publish(f'hermes/audioServer/{self.site_id}/audioFrame', wavbytes)
-                    time.sleep(0.1)
-
-                    self.client.publish(self.ON_ASR_STOP_LISTENING, json.dumps({'siteId': self.site_id, 'sessionId': self.session_id}))
-                    
-                    for i in range(100):
-                        if self.intent_received:
-                            break
-                        time.sleep(0.05)
-                    if not self.intent_received:
-                        print('No intent - time out!')
-                    self.intent_received = False
+            if session.intent is None:
+                print(f'Error: intent not recognized ({session.file})')
+            else:
+                print(f'{session.file}:\t{session.sentence!r} -> {session.intent} (target {session.target_intent})')
+                self.test_log[session.file] = (session.sentence, session.intent, session.target_intent)
+            self.sessions.finish(session)
+
+    def __expire_eval_sessions(self, timeout):
+        # Sessions still streaming their audio do not time out
+        for session in self.sessions.expire(timeout, lambda s: s.file is not None and s.audio_done is not None):
+            self.__trace_end(session.site_id, session.session_id, 'timeout')
+            print(f'No intent - time out! ({session.file})')
+
+    def __eval_in_flight(self):
+        return self.sessions.count(lambda s: s.file is not None)
+
+    def __eval_items(self, path):
+        # (name, pcm loader) of every clip, either audio files in path or clips of packed shards (see shards.py)
+        if is_shard_folder(path):
+            for reader in ShardDataset(path).readers:
+                for name, samplerate, data in reader:
+                    yield f'{reader.path}:{name}', lambda samplerate=samplerate, data=data: (samplerate, data)
+        else:
+            for file in sorted(os.listdir(path)):
+                if file.endswith(('.mp3', '.wav', '.ogg')):
+                    file = os.path.join(path, file)
+                    yield file, lambda file=file: (16000, decode_to_pcm(file))
+
+    def __start_eval_session(self, session, samplerate, pcm, streamer):
+        site_id = self.site_id
+        # eval-<i> ids repeat in every evaluation_loop run, so the span of an earlier run is dropped
+        if self.metrics is not None:
+            self.metrics.begin(site_id, session.session_id, 'start_listening')
+        self.client.publish(self.ON_ASR_START_LISTENING, json.dumps({'siteId': site_id, 'sessionId': session.session_id, 'stopOnSilence': False, 'sendAudioCaptured': True}))
+
+        def audio_done():
+            session.audio_done = time.perf_counter()
+            self.client.publish(self.ON_ASR_STOP_LISTENING, json.dumps({'siteId': site_id, 'sessionId': session.session_id}))
+
+        streamer.submit(self.ON_AUDIO_SESSION_FRAME.format(siteId=site_id, sessionId=session.session_id), pcm, samplerate, audio_done)
+
+    def evaluation_loop(self, path='./data/', max_in_flight=1, timeout=5.0, frame_ms=30, pacing=AudioStreamPublisher.REALTIME, store=None):
+        '''Sends every audio file (or every clip of a shard folder) in path through Rhasspy and records the recognised intents in test_log.
+
+        Up to max_in_flight ASR sessions run concurrently, each with its own sessionId. Audio is decoded once to
+        memory-mapped PCM and streamed as audioSessionFrame WAV frames of frame_ms, like a live microphone, either in
+        real time (pacing='realtime') or as fast as possible (pacing='max'). Latency is measured from the end of the
+        audio to the intent. Returns throughput and latency stats.
+
+        With an eval_store.EvalStore, clips that were already evaluated with the current NLU model are not sent
+        again, their stored results go to test_log, new results are added to the store. The model is the store's
+        one plus sentences.ini and nlu_paths() if queries are answered in-process. Clips that ended with an ASR
+        error or timed out are not stored.
+        '''
+        self.__loop_start()
+        streamer = AudioStreamPublisher(self.client, frame_ms=frame_ms, pacing=pacing)
+
+        items = list(self.__eval_items(path))
+        hashes, skipped, model = {}, 0, None
+        if store is not None:
+            nlu_paths = self.nlu_paths()
+            model = model_fingerprint(nlu_paths=nlu_paths) if nlu_paths else store.model
+            hashes = {file: audio_hash(*load_audio()) for file, load_audio in items}
+            stored = store.lookup(hashes.values(), model)
+            for file, _ in items:
+                if hashes[file] in stored:
+                    sentence, intent = stored[hashes[file]]
+                    if intent is not None:
+                        self.test_log[file] = (sentence, intent, os.path.basename(file).split(':')[-1].split('-')[1])
+            skipped = sum(1 for file, _ in items if hashes[file] in stored)
+            items = [(file, load_audio) for file, load_audio in items if hashes[file] not in stored]
+            print(f'{skipped} clips already evaluated with model {model[:12]}, {len(items)} to go')
+        evaluated = []
+        started = time.perf_counter()
+
+        for i, (file, load_audio) in enumerate(items):
+            with self.sessions.changed:
+                while self.__eval_in_flight() >= max_in_flight:
+                    self.sessions.changed.wait(timeout=0.05)
+                    self.__expire_eval_sessions(timeout)
+                session = self.sessions.start(self.site_id, f'eval-{i}', file, os.path.basename(file).split(':')[-1].split('-')[1])
+
+            print("\nTesting:\t", file)
+            self.__start_eval_session(session, *load_audio(), streamer)
+            evaluated.append(session)
+
+        with self.sessions.changed:
+            while self.__eval_in_flight():
+                self.sessions.changed.wait(timeout=0.05)
+                self.__expire_eval_sessions(timeout)
+        streamer.close()
+
+        if store is not None:
+            # Expired sessions never finish, ASR errors say nothing about the NLU model
+            store.put_many([(hashes[s.file], s.file, s.target_intent, s.sentence, s.intent, s.finished - (s.audio_done or s.started))
+                            for s in evaluated if s.finished is not None and s.error is None], model)
+
+        elapsed = time.perf_counter() - started
+        completed = [s.finished - (s.audio_done or s.started) for s in evaluated if s.finished is not None]
+        stats = {
+            'model': model,
+            'files': len(items),
+            'skipped': skipped,
+            'completed': len(completed),
+            'audio_frames': streamer.frames,
+            'files_per_sec': len(items) / elapsed if elapsed > 0 else 0.0,
+            'latency_p50': float(np.percentile(completed, 50)) if completed else None,
+            'latency_p95': float(np.percentile(completed, 95)) if completed else None,
+        }
+        print(f"\n{stats['completed']}/{stats['files']} files in {elapsed:.2f}s ({stats['files_per_sec']:.2f} files/s)")
+        if completed:
+            print(f"Latency p50: {stats['latency_p50'] * 1000:.1f} ms, p95: {stats['latency_p95'] * 1000:.1f} ms")
+        if self.exact_index is not None or self.intent_memo is not None:
+            stats.update(self.lookup_stats())
+            print(f"Lookups: {stats['exact_hits']} exact, {stats['memo_hits']} memo, {stats['lookup_misses']} misses")
+        if self.fast_classifier is not None:
+            stats.update(self.fast_path_stats())
+            if stats['fast_path_hit_rate'] is not None:
+                print(f"Fast path: {stats['fast_path_hit_rate'] * 100:.1f} % hits, "
+                      f"p50 {stats['fast_path_latency_p50'] * 1e6:.0f} us, p95 {stats['fast_path_latency_p95'] * 1e6:.0f} us")
+        return stats
 
     def loop(self):
         self.client.loop_forever()
@@ -192,7 +508,7 @@ class Broker:
         try:
             while True:
                 message = input('Send message: ')
-                self.client.publish('hermes/nlu/query', json.dumps({'input': message, 'siteId': self.site_id}))
+                self.client.publish(self.ON_NLU_QUERY, json.dumps({'input': message, 'siteId': self.site_id}))
                 time.sleep(0.1)
         except KeyboardInterrupt:
             self.client.disconnect()
@@ -211,26 +527,59 @@ class Broker:
         return correct / total
 
     def send_message(self, message):
-        self.client.publish('hermes/nlu/query', json.dumps({'input': message, 'siteId': self.site_id}))
-
-    def start_asr(self):
-        # Hotword -> Start ASR Session
-        self.is_recording = True
-        print("Starting ASR...")
-        self.client.publish(self.ON_ASR_START_LISTENING, json.dumps({'stopOnSilence': False, 'sessionId': self.session_id, 'sendAudioCaptured': True}))
-        self.client.subscribe(f"rhasspy/asr/default/{self.session_id}/audioCaptured")
-
-    def stop_asr(self):
-        # Intent -> Stop ASR Session
-        self.is_recording = False
-        print("Stopping ASR...")
-        self.client.publish(self.ON_ASR_STOP_LISTENING)
-        # client.unsubscribe("rhasspy/asr/default/" + str(sessionID) + "/audioCaptured")
+        self.client.publish(self.ON_NLU_QUERY, json.dumps({'input': message, 'siteId': self.site_id}))
+
+    @property
+    def is_recording(self):
+        '''True while a live (hotword started) session is open on any site.'''
+        return self.sessions.count(lambda s: s.file is None) > 0
+
+    def session_stats(self):
+        '''Active/started/finished/expired session counters and approximate bytes per active session.'''
+        return self.sessions.stats()
+
+    def start_asr(self, site_id=None, detected=None):
+        # Hotword -> Start ASR Session, audioCaptured of all sessions arrives on the wildcard subscription
+        site_id = site_id or self.site_id
+        for session in self.sessions.expire(self.session_timeout, lambda s: s.file is None):
+            self.__trace_end(session.site_id, session.session_id, 'timeout')
+            print(f'Session {session.session_id} of {session.site_id} timed out')
+        session = self.sessions.start(site_id, str(self.session_id))
         self.session_id += 1
+        print(f"Starting ASR ({site_id})...")
+        if self.metrics is not None:
+            # A new session starts a new span, even if a Broker before this one used the same ids
+            if detected is not None:
+                self.metrics.begin(site_id, session.session_id, 'hotword', detected)
+            else:
+                self.metrics.begin(site_id, session.session_id, 'start_listening')
+        self.client.publish(self.ON_ASR_START_LISTENING, json.dumps({'siteId': site_id, 'stopOnSilence': False, 'sessionId': session.session_id, 'sendAudioCaptured': True}))
+        if detected is not None:
+            self.__trace(site_id, session.session_id, 'start_listening')
+        return session
 
+    def stop_asr(self, site_id=None, session_id=None):
+        # Intent -> Stop ASR Session
+        site_id = site_id or self.site_id
+        session = self.sessions.get(site_id, session_id)
+        if session is not None:
+            self.sessions.finish(session)
+        print(f"Stopping ASR ({site_id})...")
+        self.client.publish(self.ON_ASR_STOP_LISTENING, json.dumps({'siteId': site_id, 'sessionId': session_id}))
 
 if __name__ == '__main__':
     brkr = Broker()
+    # Answer confident queries in-process, the rest goes to Rasa
+    # from intent_classifier import FastIntentClassifier
+    # brkr = Broker(fast_classifier=FastIntentClassifier.from_dataset())
+    # Answer training sentences and repeated queries without a round trip
+    # from nlu_cache import ExactMatchIndex, IntentMemo
+    # brkr = Broker(exact_index=ExactMatchIndex.from_dataset(), intent_memo=IntentMemo())
     # brkr.message_loop()
+    # Only send clips that were not evaluated with the current rasa/data/nlu.yml + rasa/config.yml (and NLU paths) yet
+    # from eval_store import EvalStore, print_report
+    # store = EvalStore()
+    # stats = brkr.evaluation_loop(path='./data/02-M/', store=store)
+    # print_report(store.report(stats['model']))
     brkr.evaluation_loop(path='./data/02-M/')
     print('\nAccuracy:', brkr.accuracy())
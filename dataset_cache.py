@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Compiled, indexed cache of the Rhasspy style dataset files (dataset/*.ini)
+
+Every ini file is parsed once into intent -> sentences, sentence -> intent/tags and a set of normalized
+sentences. The compiled files are pickled to cache/dataset.pkl and re-parsed only when their mtime or size
+changes. Also generates rasa/data/nlu.yml from sentences_tags.ini:
+
+python3 dataset_cache.py --write-nlu rasa/data/nlu.yml
+"""
+
+import os
+import re
+import pickle
+import argparse
+import itertools
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DATASET_ROOT = os.path.join(ROOT, 'dataset')
+CACHE_PATH = os.path.join(ROOT, 'cache', 'dataset.pkl')
+
+SOURCES = {
+    'sentences': 'sentences.ini',
+    'sentences_tags': 'sentences_tags.ini',
+    'positive': 'positive.ini',
+    'negative': 'negative.ini',
+}
+
+# Entities of rasa/data/nlu.yml and rasa/domain.yml whose name differs from their tag in sentences_tags.ini
+ENTITY_NAMES = {('Turn', 'direction'): 'trend'}
+
+_ALTERNATIVES = re.compile(r'\(([^()]*)\)(?:\{(\w+)\})?')
+_PUNCTUATION = re.compile(r"[^\w\s']")
+_WHITESPACE = re.compile(r'\s+')
+_ENTITY = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+
+
+def normalize(text: str) -> str:
+    """normalize a sentence for matching: lower case, no punctuation, single spaces
+
+    :param text: raw sentence
+    :return: normalized sentence
+    """
+    return _WHITESPACE.sub(' ', _PUNCTUATION.sub(' ', text.lower())).strip()
+
+
+def expand(sentence: str) -> List[Tuple[str, Dict[str, str]]]:
+    """expand the alternatives of a template like "turn (left | right){direction}"
+
+    :param sentence: sentence template
+    :return: List of (sentence, {tag: value}) for every combination of alternatives
+    """
+    return _expand(sentence)
+
+
+def expand_entities(sentence: str, entity_names: Optional[Dict[str, str]] = None) -> List[str]:
+    """expand a template like expand(), tagged alternatives are annotated as Rasa entities where they stand
+
+    :param sentence: sentence template, e.g. "turn (left | right){direction}"
+    :param entity_names: tag -> entity name, tags that are not in it are used as entity name
+    :return: List of annotated sentences, e.g. "turn [left](direction)"
+    """
+    return [text for text, _ in _expand(sentence, entity_names or {})]
+
+
+def _expand(sentence: str, entity_names: Optional[Dict[str, str]] = None) -> List[Tuple[str, Dict[str, str]]]:
+    # With entity_names, the value of a tagged group is written as [value](entity) at the position of the group
+    groups = list(_ALTERNATIVES.finditer(sentence))
+    if not groups:
+        return [(sentence.strip(), {})]
+
+    options = [[alt.strip() for alt in group.group(1).split('|')] for group in groups]
+    result = []
+    for combination in itertools.product(*options):
+        parts, tags, last = [], {}, 0
+        for group, value in zip(groups, combination):
+            parts.append(sentence[last:group.start()])
+            tag = group.group(2)
+            if tag:
+                tags[tag] = value
+            if tag and value and entity_names is not None:
+                parts.append(f'[{value}]({entity_names.get(tag, tag)})')
+            else:
+                parts.append(value)
+            last = group.end()
+        parts.append(sentence[last:])
+        result.append((_WHITESPACE.sub(' ', ''.join(parts)).strip(), tags))
+    return result
+
+
+class CompiledIni:
+    """parsed content of one ini file"""
+    __slots__ = ('path', 'mtime', 'size', 'sentences', 'intents', 'sentence_intent', 'sentence_tags', 'normalized')
+
+    def __init__(self, path: str):
+        stat = os.stat(path)
+        self.path = path
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+
+        # Same lines get_sentences_from_txt always returned: no headers, no empty lines, right stripped
+        self.sentences: List[str] = []
+        self.intents: Dict[str, List[str]] = {}
+        # normalized (expanded) sentence -> intent / tags
+        self.sentence_intent: Dict[str, str] = {}
+        self.sentence_tags: Dict[str, Dict[str, str]] = {}
+
+        intent = None
+        with open(path, 'r') as file:
+            for line in file:
+                if "[" in line:
+                    intent = line.strip().strip('[]')
+                    self.intents.setdefault(intent, [])
+                    continue
+                sentence = line.rstrip()
+                if sentence == '':
+                    continue
+                self.sentences.append(sentence)
+                self.intents.setdefault(intent, []).append(sentence)
+                for text, tags in expand(sentence):
+                    key = normalize(text)
+                    self.sentence_intent.setdefault(key, intent)
+                    if tags:
+                        self.sentence_tags.setdefault(key, tags)
+
+        self.normalized = frozenset(self.sentence_intent)
+
+    def to_dict(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'CompiledIni':
+        compiled = cls.__new__(cls)
+        for slot in cls.__slots__:
+            setattr(compiled, slot, state[slot])
+        return compiled
+
+    def is_current(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_mtime == self.mtime and stat.st_size == self.size
+
+
+class DatasetCache:
+    """compiled ini files by absolute path, persisted in one pickle"""
+
+    def __init__(self, cache_path: str = CACHE_PATH):
+        self.cache_path = cache_path
+        self._files: Dict[str, CompiledIni] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    self._files = {path: CompiledIni.from_dict(state) for path, state in pickle.load(f).items()}
+            except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+                self._files = {}
+
+    def get(self, path: str) -> CompiledIni:
+        """compiled content of an ini file, re-parsed only if it changed since it was cached
+
+        :param path: path of the ini file
+        :return: CompiledIni of the file
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            compiled = self._files.get(path)
+            if compiled is None or not compiled.is_current():
+                compiled = CompiledIni(path)
+                self._files[path] = compiled
+                self.__save()
+            return compiled
+
+    def source(self, name: str, root: str = DATASET_ROOT) -> CompiledIni:
+        """compiled content of one of the dataset SOURCES ('sentences', 'sentences_tags', 'positive', 'negative')"""
+        return self.get(os.path.join(root, SOURCES[name]))
+
+    def lookup(self, text: str, name: str = 'sentences') -> Optional[str]:
+        """intent of a training sentence (after normalization) or None"""
+        return self.source(name).sentence_intent.get(normalize(text))
+
+    def __save(self):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = f'{self.cache_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            # Plain dicts, so the pickle does not depend on the module the classes were loaded from
+            pickle.dump({path: compiled.to_dict() for path, compiled in self._files.items()}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+
+
+_default_cache = None
+
+
+def default_cache() -> DatasetCache:
+    """process wide DatasetCache on cache/dataset.pkl"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DatasetCache()
+    return _default_cache
+
+
+def write_nlu_yaml(tags_path: str, save_path: str, entity_names: Dict[Tuple[str, str], str] = ENTITY_NAMES):
+    """write a Rasa nlu.yml with one example per expanded sentence, tags become entities
+
+    Entities are annotated at the position of their group in the template, the file has the CRLF line endings
+    of the checked-in rasa/data/nlu.yml.
+
+    :param tags_path: path of sentences_tags.ini
+    :param save_path: path of the nlu.yml that should be written
+    :param entity_names: (intent, tag) -> entity name, where the Rasa entity is not called like the tag
+    """
+    compiled = default_cache().get(tags_path)
+    with open(save_path, 'w', newline='\r\n') as file:
+        file.write('version: "3.1"\nnlu:\n')
+        for intent, sentences in compiled.intents.items():
+            names = {tag: name for (tag_intent, tag), name in entity_names.items() if tag_intent == intent}
+            file.write(f'- intent: {intent}\n  examples: |\n')
+            for sentence in sentences:
+                for text in expand_entities(sentence, names):
+                    file.write(f'    - {text}\n')
+
+
+def read_nlu_yaml(path: str) -> Dict[str, List[str]]:
+    """read the examples of a Rasa nlu.yml (as written by write_nlu_yaml), entity markup is removed
+
+    :param path: path of the nlu.yml
+    :return: intent -> example sentences
+    """
+    intents: Dict[str, List[str]] = {}
+    intent = None
+    with open(path, 'r') as file:
+        for line in file:
+            stripped = line.strip()
+            if stripped.startswith('- intent:'):
+                intent = stripped[len('- intent:'):].strip()
+                intents.setdefault(intent, [])
+            elif stripped.startswith(('- regex:', '- synonym:', '- lookup:')):
+                intent = None
+            elif intent is not None and stripped.startswith('- ') and line.startswith('    '):
+                intents[intent].append(_ENTITY.sub(r'\1', stripped[2:]).strip())
+    return intents
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile the dataset cache')
+    parser.add_argument('--write-nlu', type=str, default=None,
+                        help='Also generate a Rasa nlu.yml from sentences_tags.ini at this path')
+    args = parser.parse_args()
+
+    cache = default_cache()
+    for name in SOURCES:
+        compiled = cache.source(name)
+        print(f'{SOURCES[name]:20s} {len(compiled.intents):3d} intents {len(compiled.sentences):5d} sentences '
+              f'{len(compiled.normalized):5d} unique normalized')
+
+    if args.write_nlu:
+        write_nlu_yaml(os.path.join(DATASET_ROOT, SOURCES['sentences_tags']), args.write_nlu)
+        print(f'Wrote {args.write_nlu}')
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Topic-first MQTT message dispatch
+
+Handlers are registered for topic filters (MQTT wildcards + and # included) in a trie. A message is routed by
+its topic first, its payload is decoded only if a matching handler asks for it, and at most once per message.
+"""
+
+import json
+import threading
+
+
+class TopicDispatcher:
+    JSON   = 'json'         # handler(topic, dict), {} for empty or undecodable payloads
+    BINARY = 'binary'       # handler(topic, bytes)
+    NONE   = 'none'         # handler(topic, None)
+
+    def __init__(self, max_cached_topics=1024):
+        self._root = {}
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._registered = 0
+        self.max_cached_topics = max_cached_topics
+
+    def register(self, topic_filter, handler, payload=JSON):
+        '''Adds handler for topic_filter, handlers of a topic run in registration order.'''
+        if payload not in (self.JSON, self.BINARY, self.NONE):
+            raise ValueError(f'Unknown payload type: {payload}')
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split('/'):
+                node = node.setdefault(level, {})
+            # Leaves are stored under the key None, which no topic level can collide with
+            node.setdefault(None, []).append((self._registered, handler, payload))
+            self._registered += 1
+            self._cache = {}
+
+    def match(self, topic):
+        '''(handler, payload type) of every filter matching topic, in registration order.'''
+        handlers = self._cache.get(topic)
+        if handlers is not None:
+            return handlers
+
+        found = []
+        levels = topic.split('/')
+        nodes = [self._root]
+        for i, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                if '#' in node and not (i == 0 and topic.startswith('$')):
+                    found.extend(node['#'].get(None, ()))
+                for key in (level, '+'):
+                    child = node.get(key)
+                    if child is not None and not (key == '+' and i == 0 and topic.startswith('$')):
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            found.extend(node.get(None, ()))
+            # "a/#" also matches "a"
+            if '#' in node:
+                found.extend(node['#'].get(None, ()))
+
+        handlers = tuple((handler, payload) for _, handler, payload in sorted(found, key=lambda entry: entry[0]))
+        if len(self._cache) >= self.max_cached_topics:
+            self._cache = {}
+        self._cache[topic] = handlers
+        return handlers
+
+    def dispatch(self, topic, payload):
+        '''Calls every handler of topic, returns False if none matched.'''
+        handlers = self.match(topic)
+        decoded = None
+        for handler, kind in handlers:
+            if kind == self.JSON:
+                if decoded is None:
+                    decoded = self.decode_json(payload)
+                handler(topic, decoded)
+            elif kind == self.BINARY:
+                handler(topic, payload)
+            else:
+                handler(topic, None)
+        return bool(handlers)
+
+    @staticmethod
+    def decode_json(payload):
+        if not payload:
+            return {}
+        try:
+            decoded = json.loads(payload)
+        except ValueError:
+            # Unexpected binary or malformed payload on a JSON topic
+            return {}
+        return decoded if isinstance(decoded, dict) else {}
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Content-addressed cache for wav2vec2 features: in-memory LRU in front of an on-disk .npy store
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def file_fingerprint(path, block=1 << 20):
+    '''Cheap fingerprint of a large file: name, size and a hash of its first and last block.'''
+    sha = hashlib.sha1()
+    size = os.path.getsize(path)
+    sha.update(f'{os.path.basename(path)}:{size}'.encode())
+    with open(path, 'rb') as f:
+        sha.update(f.read(block))
+        if size > block:
+            f.seek(max(block, size - block))
+            sha.update(f.read(block))
+    return sha.hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, root, fingerprint, max_items=1024, max_disk_bytes=1 << 30):
+        self.root = root
+        self.fingerprint = fingerprint
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._disk_bytes = sum(os.path.getsize(path) for path in self.__files())
+
+    def key(self, data):
+        '''Key for raw audio (file bytes or a signal array) under the current model fingerprint.'''
+        sha = hashlib.sha1(self.fingerprint.encode())
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data, dtype=np.float32)
+        sha.update(memoryview(data).cast('B'))
+        return sha.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            features = self._memory.get(key)
+            if features is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return features
+
+        path = self.__path(key)
+        try:
+            features = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self.__remember(key, features)
+        return features
+
+    def put(self, key, features):
+        features = np.asarray(features, dtype=np.float32)
+        with self._lock:
+            self.__remember(key, features)
+
+        path = self.__path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, features)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._disk_bytes += os.path.getsize(path)
+            if self._disk_bytes > self.max_disk_bytes:
+                self.__evict()
+
+    def __remember(self, key, features):
+        self._memory[key] = features
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def __path(self, key):
+        return os.path.join(self.root, key[:2], f'{key}.npy')
+
+    def __files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.npy'):
+                    yield os.path.join(dirpath, filename)
+
+    def __evict(self):
+        # Least recently used first (get() touches the files it reads), down to 90 % of the budget
+        files = sorted(self.__files(), key=os.path.getmtime)
+        for path in files:
+            if self._disk_bytes <= self.max_disk_bytes * 0.9:
+                break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
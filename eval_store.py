@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Persisted evaluation results, keyed by audio content hash and NLU model fingerprint (sqlite)
+
+Broker.evaluation_loop(store=EvalStore()) skips clips that were already evaluated with the current
+rasa/data/nlu.yml and rasa/config.yml, plus sentences.ini and the settings of the in-process NLU paths
+(exact-match index, intent memo, fast classifier) if the Broker answers queries itself. ASR errors and
+timeouts are not stored, those clips are evaluated again. The report of a model is computed from the store:
+
+python3 eval_store.py                  # confusion matrix and latencies of the current model
+python3 eval_store.py --all-models     # every fingerprint in the store
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import threading
+import numpy as np
+
+from dataset_cache import DATASET_ROOT, ROOT, SOURCES
+
+
+RESULTS_PATH = os.path.join(ROOT, 'cache', 'eval_results.sqlite')
+MODEL_FILES = (os.path.join(ROOT, 'rasa', 'data', 'nlu.yml'), os.path.join(ROOT, 'rasa', 'config.yml'))
+SENTENCES_FILE = os.path.join(DATASET_ROOT, SOURCES['sentences'])
+NOT_RECOGNIZED = '<none>'
+
+
+def model_fingerprint(paths=MODEL_FILES, nlu_paths=None):
+    '''Hash of the files that define the NLU model, missing files count as empty.
+
+    nlu_paths is the configuration of the in-process NLU paths in front of Rasa (see Broker.nlu_paths()). If any
+    is active, it and sentences.ini, which they are built from, are part of the hash.
+    '''
+    if nlu_paths:
+        paths = (*paths, SENTENCES_FILE)
+    sha = hashlib.sha1()
+    for path in paths:
+        sha.update(os.path.basename(path).encode())
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+    if nlu_paths:
+        sha.update(json.dumps(nlu_paths, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def audio_hash(samplerate, pcm):
+    '''Hash of the audio content that is sent to Rhasspy (samplerate and int16 samples).'''
+    sha = hashlib.sha1(str(samplerate).encode())
+    sha.update(memoryview(np.ascontiguousarray(pcm)).cast('B'))
+    return sha.hexdigest()
+
+
+class EvalStore:
+    '''Evaluation results of (audio, model) pairs, model defaults to the fingerprint of the current NLU model.'''
+    def __init__(self, path=RESULTS_PATH, model=None):
+        self.model = model or model_fingerprint()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Results are written from the evaluation thread, reports may be read from others
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                        "(audio TEXT, model TEXT, file TEXT, target TEXT, sentence TEXT, intent TEXT, latency REAL, "
+                        "evaluated REAL, PRIMARY KEY (audio, model))")
+
+    def lookup(self, hashes, model=None):
+        '''{audio hash: (sentence, intent or None)} of the hashes that have a result for a model (default: current).'''
+        result = {}
+        hashes = list(hashes)
+        with self._lock:
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                rows = self.db.execute(
+                    f"SELECT audio, sentence, intent FROM results WHERE model = ? AND audio IN ({','.join('?' * len(chunk))})",
+                    [model or self.model, *chunk])
+                result.update((audio, (sentence, intent)) for audio, sentence, intent in rows)
+        return result
+
+    def put_many(self, results, model=None):
+        '''Stores (audio hash, file, target, sentence, intent or None, latency) tuples for a model (default: current).'''
+        now = time.time()
+        model = model or self.model
+        with self._lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(audio, model, file, target, sentence, intent, latency, now)
+                                 for audio, file, target, sentence, intent, latency in results])
+
+    def results(self, model=None):
+        '''{file: (sentence, intent, target)} of a model, in the format of Broker.test_log.'''
+        with self._lock:
+            rows = self.db.execute("SELECT file, sentence, intent, target FROM results WHERE model = ?",
+                                   [model or self.model]).fetchall()
+        return {file: (sentence, intent, target) for file, sentence, intent, target in rows}
+
+    def models(self):
+        with self._lock:
+            return [model for model, in self.db.execute("SELECT DISTINCT model FROM results ORDER BY model")]
+
+    def report(self, model=None):
+        '''Accuracy, per-intent confusion matrix, precision/recall and latency percentiles of a model.'''
+        with self._lock:
+            rows = self.db.execute("SELECT target, intent, latency FROM results WHERE model = ?",
+                                   [model or self.model]).fetchall()
+        if not rows:
+            return None
+
+        targets = np.array([target.lower() for target, _, _ in rows])
+        predictions = np.array([(intent or NOT_RECOGNIZED).lower() for _, intent, _ in rows])
+        latencies = np.array([np.nan if latency is None else latency for _, _, latency in rows], dtype=np.float64)
+
+        labels, indices = np.unique(np.concatenate([targets, predictions]), return_inverse=True)
+        k = len(labels)
+        t, p = indices[:len(rows)], indices[len(rows):]
+        confusion = np.bincount(t * k + p, minlength=k * k).reshape(k, k)
+
+        correct = np.diag(confusion)
+        support = confusion.sum(axis=1)
+        predicted = confusion.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            recall = np.where(support > 0, correct / support, np.nan)
+            precision = np.where(predicted > 0, correct / predicted, np.nan)
+
+        per_intent = {}
+        measured = ~np.isnan(latencies)
+        for i, label in enumerate(labels):
+            values = latencies[(t == i) & measured]
+            if len(values):
+                per_intent[label] = (float(np.percentile(values, 50)), float(np.percentile(values, 95)))
+
+        valid = latencies[measured]
+        return {
+            'model': model or self.model,
+            'files': len(rows),
+            'accuracy': float(correct.sum() / len(rows)),
+            'labels': labels.tolist(),
+            'confusion': confusion,
+            'precision': precision,
+            'recall': recall,
+            'support': support,
+            'latency_p50': float(np.percentile(valid, 50)) if len(valid) else None,
+            'latency_p95': float(np.percentile(valid, 95)) if len(valid) else None,
+            'latency_per_intent': per_intent,
+        }
+
+    def close(self):
+        self.db.close()
+
+
+def print_report(report):
+    if report is None:
+        print('No results')
+        return
+    labels = report['labels']
+    width = max(8, *(len(label) for label in labels))
+    print(f"Model {report['model'][:12]}: {report['files']} files, accuracy {report['accuracy']:.3f}")
+    if report['latency_p50'] is not None:
+        print(f"Latency p50 {report['latency_p50'] * 1000:.1f} ms, p95 {report['latency_p95'] * 1000:.1f} ms")
+
+    print('\nConfusion (rows: target, columns: predicted)')
+    print(' ' * width + ''.join(f'{i:>5d}' for i in range(len(labels))))
+    for i, label in enumerate(labels):
+        print(f'{label:>{width}s}' + ''.join(f'{count:5d}' for count in report['confusion'][i]) + f'   [{i}]')
+
+    print(f"\n{'intent':>{width}s} {'support':>8s} {'precision':>10s} {'recall':>8s} {'p50 ms':>8s} {'p95 ms':>8s}")
+    for i, label in enumerate(labels):
+        if report['support'][i] == 0:
+            continue
+        p50, p95 = report['latency_per_intent'].get(label, (np.nan, np.nan))
+        print(f"{label:>{width}s} {report['support'][i]:8d} {report['precision'][i]:10.3f} {report['recall'][i]:8.3f} "
+              f"{p50 * 1000:8.1f} {p95 * 1000:8.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report persisted evaluation results')
+    parser.add_argument('--path', type=str, default=RESULTS_PATH, help='Path of the results database')
+    parser.add_argument('--model', type=str, default=None, help='Model fingerprint (default: current NLU model)')
+    parser.add_argument('--all-models', action='store_true', help='Report every model in the store')
+    args = parser.parse_args()
+
+    store = EvalStore(args.path, args.model)
+    for model in (store.models() if args.all_models else [store.model]):
+        print_report(store.report(model))
+        print()
+    store.close()
@@ -2,10 +2,10 @@
 
 import random
 import json
-import numpy as np
-
 from paho.mqtt import client as mqtt_client
 
+from audiobuffer import decode_pcm16
+
 # CONFIG
 broker = 'localhost'
 port = 12183
@@ -59,8 +59,7 @@ def subscribe(client: mqtt_client):
         elif "hermes/intent/" in topic:
             stopASR(client)
         elif "audioCaptured" in topic:
-            pl = np.fromstring(msg.payload, np.int16)
-            pl = pl.astype(np.float32, order='C') / 32768.0
+            pl = decode_pcm16(msg.payload)
             print(pl)
         else:
             # Should not happen...
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+In-process fast-path intent classifier compiled from dataset/sentences.ini
+
+Char n-gram TF-IDF vectors of all (expanded) training sentences are held as a sparse NumPy/SciPy matrix.
+A query is scored by cosine similarity against every training sentence, the best sentence per intent is
+the intent score. Only confident answers are used, everything else falls through to Rasa.
+
+python3 intent_classifier.py "please sit down"
+"""
+
+import sys
+import time
+import numpy as np
+from scipy import sparse
+
+from dataset_cache import default_cache, expand, normalize
+
+
+class FastIntentClassifier:
+    def __init__(self, min_n=2, max_n=4, threshold=0.85, margin=0.1):
+        self.min_n = min_n
+        self.max_n = max_n
+        self.threshold = threshold
+        self.margin = margin
+
+        self.vocabulary = {}
+        self.idf = None
+        self.intents = []
+        self.offsets = None         # start row of every intent in the sorted training matrix
+        self.matrix = None          # (ngrams x sentences), columns are L2 normalized TF-IDF vectors
+
+    @classmethod
+    def from_dataset(cls, path=None, **kwargs):
+        '''Classifier trained on sentences.ini (or another ini file) through the compiled dataset cache.'''
+        cache = default_cache()
+        compiled = cache.get(path) if path else cache.source('sentences')
+        texts, labels = [], []
+        for intent, sentences in compiled.intents.items():
+            for sentence in sentences:
+                for text, _ in expand(sentence):
+                    texts.append(text)
+                    labels.append(intent)
+        return cls(**kwargs).fit(texts, labels)
+
+    def __ngrams(self, text):
+        # Like char_wb: n-grams inside space padded words
+        for word in normalize(text).split():
+            word = f' {word} '
+            for n in range(self.min_n, self.max_n + 1):
+                for i in range(len(word) - n + 1):
+                    yield word[i:i + n]
+
+    def __counts(self, text, grow=False):
+        counts = {}
+        for ngram in self.__ngrams(text):
+            column = self.vocabulary.get(ngram)
+            if column is None:
+                if not grow:
+                    continue
+                column = self.vocabulary[ngram] = len(self.vocabulary)
+            counts[column] = counts.get(column, 0) + 1
+        return counts
+
+    def fit(self, texts, labels):
+        order = sorted(range(len(texts)), key=lambda i: labels[i])
+        rows, cols, values = [], [], []
+        for col, i in enumerate(order):
+            for row, count in self.__counts(texts[i], grow=True).items():
+                rows.append(row)
+                cols.append(col)
+                values.append(count)
+
+        counts = sparse.csr_matrix((np.array(values, dtype=np.float32), (rows, cols)),
+                                   shape=(len(self.vocabulary), len(texts)))
+        df = np.diff(counts.indptr)
+        self.idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+
+        tfidf = sparse.diags(self.idf) @ counts
+        norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=0))).ravel()
+        self.matrix = (tfidf @ sparse.diags(1 / np.maximum(norms, 1e-12))).astype(np.float32).tocsr()
+
+        sorted_labels = [labels[i] for i in order]
+        self.intents = list(dict.fromkeys(sorted_labels))
+        self.offsets = np.array([sorted_labels.index(intent) for intent in self.intents])
+        return self
+
+    def scores(self, text):
+        '''Best cosine similarity per intent, as an array aligned with self.intents.'''
+        counts = self.__counts(text)
+        if not counts:
+            return np.zeros(len(self.intents), dtype=np.float32)
+
+        columns = np.fromiter(counts, dtype=np.int64, count=len(counts))
+        query = np.fromiter(counts.values(), dtype=np.float32, count=len(counts)) * self.idf[columns]
+        query /= np.linalg.norm(query)
+
+        # Sparse dot product over only the rows of the query's n-grams
+        indptr, indices, data = self.matrix.indptr, self.matrix.indices, self.matrix.data
+        rows = [(indptr[c], indptr[c + 1], q) for c, q in zip(columns.tolist(), query.tolist())]
+        similarity = np.bincount(
+            np.concatenate([indices[start:end] for start, end, _ in rows]),
+            weights=np.concatenate([data[start:end] * q for start, end, q in rows]),
+            minlength=self.matrix.shape[1],
+        )
+        return np.maximum.reduceat(similarity, self.offsets)
+
+    def predict(self, text):
+        '''Returns (intent, confidence), intent is None if the answer is not confident enough for the fast path.'''
+        scores = self.scores(text)
+        if len(scores) == 0:
+            return None, 0.0
+        best = int(np.argmax(scores))
+        confidence = float(scores[best])
+        runner_up = float(np.partition(scores, -2)[-2]) if len(scores) > 1 else 0.0
+        if confidence >= self.threshold and confidence - runner_up >= self.margin:
+            return self.intents[best], confidence
+        return None, confidence
+
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    clf = FastIntentClassifier.from_dataset()
+    print(f'Compiled {clf.matrix.shape[1]} sentences, {clf.matrix.shape[0]} n-grams in {time.perf_counter() - start:.2f}s')
+
+    for text in sys.argv[1:] or ['sit', 'please lie down on the floor', 'what a beautiful day']:
+        start = time.perf_counter()
+        intent, confidence = clf.predict(text)
+        print(f'{text!r:35s} -> {intent} ({confidence:.2f}) in {(time.perf_counter() - start) * 1e6:.0f} us')
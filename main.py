@@ -5,13 +5,28 @@
 # @AUTHOR : Marcel Rinder
 
 
+import argparse
+
 from broker import Broker
+from batching import BatchScheduler
 from sentiment import EmotionAnalyser
+from streaming import StreamingEmotionEstimator
+from metrics import Metrics
 
 
 def callback(audio):
-    emotion = ea.predict(signal=audio)
+    # With --batch-size, concurrent utterances of several AudioWorkers share one model call
+    emotion = scheduler.predict(audio) if scheduler is not None else ea.predict(signal=audio)
     print('Emotion:\t', emotion.capitalize())
+    if scheduler is not None:
+        # Near 1.0 unless concurrent utterances have the same length, see BatchScheduler
+        print('Batching:\t', f'{scheduler.mean_batch_size:.2f} utterances per model call')
+
+    # first_inference is only known once the first utterance went through the model
+    global startup_reported
+    if not startup_reported:
+        startup_reported = True
+        print('Startup:\t', ea.startup_report())
 
     # send emotion over MQTT
     json_msg = {
@@ -38,8 +53,35 @@ def callback(audio):
 
 
 if __name__ == '__main__':
-    ea = EmotionAnalyser(categorial_output=True, show_confidence=False)
-    broker = Broker(audio_callback=callback)
+    parser = argparse.ArgumentParser(description='Emotion recognition for Rhasspy audioCaptured utterances')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='Micro-batch up to this many concurrent utterances of equal length, e.g. replayed '
+                             'evaluation audio (0: one model call per utterance)')
+    parser.add_argument('--batch-latency', type=float, default=0.02,
+                        help='Seconds an utterance waits for others to join its batch')
+    parser.add_argument('--stream', action='store_true',
+                        help='Publish provisional emotions while the user is still speaking (enamour/emotion/<siteId>/provisional)')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Serve stage latencies of every session on http://127.0.0.1:<port>/metrics (0: no metrics)')
+    args = parser.parse_args()
+
+    metrics = None
+    if args.metrics_port:
+        metrics = Metrics()
+        metrics.serve(args.metrics_port)
+
+    # Loads and warms up the model before the broker starts accepting audio
+    ea = EmotionAnalyser(categorial_output=True, show_confidence=False, warmup=True, metrics=metrics)
+    print('Startup:\t', ea.startup_report())
+    startup_reported = False
+
+    scheduler = None
+    if args.batch_size > 1:
+        scheduler = BatchScheduler(ea, max_batch_size=args.batch_size, max_latency=args.batch_latency)
+    emotion_stream = StreamingEmotionEstimator(ea) if args.stream else None
+    # One AudioWorker per batch slot, so that many utterances can wait in the scheduler together
+    broker = Broker(audio_callback=callback, workers=max(1, args.batch_size), emotion_stream=emotion_stream,
+                    metrics=metrics)
     
     # Active wait for Rhasspy event
     broker.loop()
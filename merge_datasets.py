@@ -2,6 +2,7 @@ import os
 import random
 from typing import List
 from sentiment_analysis import get_sentences_from_txt
+from dataset_cache import default_cache, normalize
 
 
 def get_neutral_sentences(pos_path: str, neg_path: str, sent_path: str, new_path: str):
@@ -13,21 +14,13 @@ def get_neutral_sentences(pos_path: str, neg_path: str, sent_path: str, new_path
     :param sent_path: path of the dataset with all sentences (neg, pos, neutral)
     :param new_path: path where the new dataset should be saved
     """
-    pos = get_sentences_from_txt(pos_path)
-    neg = get_sentences_from_txt(neg_path)
-    all_sent = get_sentences_from_txt(sent_path)
-
-    pos.extend(neg)
-
-    for elem in pos:
-        for i, elem_2 in enumerate(all_sent):
-            new = elem_2
-            if "(" in elem_2:
-                index = elem_2.index("(")
-                new = elem_2[:index].strip()
-                all_sent[i] = new
-            if elem == new:
-                all_sent.remove(elem_2)
+    cache = default_cache()
+    labelled = cache.get(pos_path).normalized | cache.get(neg_path).normalized
+
+    # Sentences with alternatives are cut before the "(", duplicates are kept only once
+    all_sent = [sentence[:sentence.index("(")].strip() if "(" in sentence else sentence
+                for sentence in cache.get(sent_path).sentences]
+    all_sent = [sentence for sentence in dict.fromkeys(all_sent) if normalize(sentence) not in labelled]
 
     neutral_sentences = random.sample(all_sent, 180)
 
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+In-process counters, histograms and per-session stage spans of the voice pipeline
+
+Components take an optional Metrics object (metrics=None disables instrumentation). Sessions are traced with
+begin(site_id, session_id, event) and mark(site_id, session_id, event): the time since the previous event of the
+session is observed as enamour_stage_seconds{stage=<event>}, the time since the first event as
+enamour_session_seconds{stage=<event>}. end() closes the span once the session has its result, late events of a
+closed span (e.g. the emotion after the intent) are still observed.
+
+    metrics = Metrics()
+    metrics.serve(9100)                          # http://127.0.0.1:9100/metrics (Prometheus), /metrics.json
+    metrics.dump_json('cache/metrics.json', 10)  # or a JSON file rewritten every 10 s
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Seconds, from 1 ms (in-process answers) to 10 s (timeouts)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'enamour_stage_seconds': 'Time from the previous event of a session to this event',
+    'enamour_session_seconds': 'Time from the first event of a session to this event',
+    'enamour_emotion_inference_seconds': 'Emotion model inference time per call',
+    'enamour_emotion_total': 'Emotion results',
+    'enamour_intents_total': 'Recognized intents',
+    'enamour_intent_not_recognized_total': 'Queries without a recognized intent',
+    'enamour_audio_dropped_total': 'audioCaptured utterances dropped because the audio queue was full',
+    'enamour_sessions_evicted_total': 'Oldest unfinished session spans dropped from the bounded span table',
+}
+
+
+class Metrics:
+    '''Thread-safe registry of labelled counters and histograms, plus the open session spans.'''
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_sessions=1024):
+        self.buckets = tuple(buckets)
+        self.max_sessions = max_sessions
+        self._counters = {}         # (name, labels) -> value
+        self._histograms = {}       # (name, labels) -> [bucket counts..., +Inf count, sum, count]
+        self._spans = OrderedDict()  # (site_id, session_id) -> (first timestamp, previous timestamp)
+        self._ended = OrderedDict()  # spans closed by end(), kept for late events of their session
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        self.__observe((name, tuple(sorted(labels.items()))), value)
+
+    def __observe(self, key, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 3)
+            histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def mark(self, site_id, session_id, event, timestamp=None):
+        '''Records event of a session, observes its stage time and the time since the session's first event.'''
+        now = time.perf_counter() if timestamp is None else timestamp
+        key = (site_id, session_id)
+        with self._lock:
+            span = self._spans.get(key)
+            if span is not None:
+                self._spans[key] = (span[0], now)
+            elif key in self._ended:
+                span = self._ended[key]
+                self._ended[key] = (span[0], now)
+            else:
+                self._spans[key] = (now, now)
+                if len(self._spans) > self.max_sessions:
+                    self._spans.popitem(last=False)
+                    evicted = ('enamour_sessions_evicted_total', ())
+                    self._counters[evicted] = self._counters.get(evicted, 0) + 1
+        if span is not None:
+            labels = (('stage', event),)
+            self.__observe(('enamour_stage_seconds', labels), now - span[1])
+            self.__observe(('enamour_session_seconds', labels), now - span[0])
+
+    def begin(self, site_id, session_id, event, timestamp=None):
+        '''Starts a new span of a session with event, drops an earlier span under the same (reused) ids.'''
+        key = (site_id, session_id)
+        with self._lock:
+            self._spans.pop(key, None)
+            self._ended.pop(key, None)
+        self.mark(site_id, session_id, event, timestamp)
+
+    def end(self, site_id, session_id):
+        '''Closes the span of a finished session, the most recent max_sessions closed spans still take late events.'''
+        key = (site_id, session_id)
+        with self._lock:
+            span = self._spans.pop(key, None)
+            if span is not None:
+                self._ended[key] = span
+                if len(self._ended) > self.max_sessions:
+                    self._ended.popitem(last=False)
+
+    def to_dict(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        result = {'counters': [], 'histograms': []}
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+        for (name, labels), values in sorted(histograms.items()):
+            result['histograms'].append({
+                'name': name,
+                'labels': dict(labels),
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], values[:-2])),
+                'sum': values[-2],
+                'count': values[-1],
+                'mean': values[-2] / values[-1] if values[-1] else None,
+            })
+        return result
+
+    def to_prometheus(self):
+        '''Text exposition format (version 0.0.4).'''
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+
+        def escape(value):
+            # Label values come from the network (siteId, intent names), the text format escapes backslash, quote and newline
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def format_labels(labels, extra=()):
+            pairs = [f'{k}="{escape(v)}"' for k, v in (*labels, *extra)]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        lines, described = [], set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in HELP:
+                    lines.append(f'# HELP {name} {HELP[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, 'counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), values in sorted(histograms.items()):
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), '+Inf'], values[:-2]):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {values[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9100, host='127.0.0.1'):
+        '''Serves /metrics (Prometheus) and /metrics.json from a daemon thread, returns the server.'''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.to_prometheus().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.to_dict()).encode(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name='MetricsServer').start()
+        return server
+
+    def dump_json(self, path, interval=10.0):
+        '''Rewrites path with to_dict() every interval seconds from a daemon thread.'''
+        def dump():
+            while True:
+                time.sleep(interval)
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                tmp_path = f'{path}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump({'time': time.time(), **self.to_dict()}, f)
+                os.replace(tmp_path, path)
+
+        thread = threading.Thread(target=dump, daemon=True, name='MetricsDump')
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    metrics = Metrics()
+    events = ('hotword', 'start_listening', 'text_captured', 'nlu_query', 'intent_parsed', 'emotion')
+    n = 10000
+    start = time.perf_counter()
+    for i in range(n):
+        metrics.begin('default', i, events[0])
+        for event in events[1:]:
+            metrics.mark('default', i, event)
+        metrics.end('default', i)
+    elapsed = time.perf_counter() - start
+    print(metrics.to_prometheus())
+    print(f'{elapsed / (n * len(events)) * 1e6:.2f} us per mark')
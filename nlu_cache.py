@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Answers repeated NLU queries without a round trip to Rasa
+
+ExactMatchIndex: normalized training sentence (sentences.ini / rasa/data/nlu.yml) -> intent
+IntentMemo:      bounded, TTL evicted memo of the intentParsed results seen on the bus for recent queries
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from dataset_cache import ROOT, default_cache, expand, normalize, read_nlu_yaml
+
+
+NLU_PATH = os.path.join(ROOT, 'rasa', 'data', 'nlu.yml')
+
+
+class ExactMatchIndex:
+    '''Hash index of normalized training sentences. Sentences listed under more than one intent are left out.'''
+    def __init__(self):
+        self.index = {}
+        self.conflicts = set()
+
+    @classmethod
+    def from_dataset(cls, sources=('sentences',), nlu_path=NLU_PATH):
+        index = cls()
+        cache = default_cache()
+        for name in sources:
+            for intent, sentences in cache.source(name).intents.items():
+                index.add(intent, (text for sentence in sentences for text, _ in expand(sentence)))
+        if nlu_path and os.path.exists(nlu_path):
+            for intent, examples in read_nlu_yaml(nlu_path).items():
+                index.add(intent, examples)
+        return index
+
+    def add(self, intent, sentences):
+        for sentence in sentences:
+            key = normalize(sentence)
+            if not key or key in self.conflicts:
+                continue
+            known = self.index.setdefault(key, intent)
+            if known != intent:
+                del self.index[key]
+                self.conflicts.add(key)
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, text):
+        '''Intent of a training sentence or None.'''
+        return self.index.get(normalize(text))
+
+
+class IntentMemo:
+    '''Last max_items query results, each valid for ttl seconds.'''
+    def __init__(self, max_items=1024, ttl=300.0):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, text):
+        '''(intent, confidence) of a recent query or None.'''
+        key = normalize(text)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            intent, confidence, expires = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return intent, confidence
+
+    def put(self, text, intent, confidence=None):
+        key = normalize(text)
+        if not key:
+            return
+        with self._lock:
+            self._items[key] = (intent, confidence, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    index = ExactMatchIndex.from_dataset()
+    print(f'Indexed {len(index)} sentences ({len(index.conflicts)} ambiguous left out) in {time.perf_counter() - start:.2f}s')
+    for text in ['Sit!', 'lie down on the floor', 'what a beautiful day']:
+        print(f'{text!r:30s} -> {index.lookup(text)}')
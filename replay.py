@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Record and replay Hermes MQTT traffic, for load tests without a live Rhasspy
+
+Log format: MAGIC, then one record per message
+    <d timestamp (seconds since start)> <H topic length> <I payload length> <topic> <payload>
+
+python3 replay.py record -o traffic.hlog --seconds 600            # hermes/# and rhasspy/# of a live Rhasspy
+python3 replay.py synth -o traffic.hlog --sessions 200 --audio ./data/02-M/
+python3 replay.py replay traffic.hlog --speed max --work-ms 40     # Broker with a simulated audio_callback
+python3 replay.py replay traffic.hlog --speed 4 --target wakeword   # getWAVafterWakeword's on_message
+"""
+
+import os
+import json
+import time
+import struct
+import argparse
+import threading
+from collections import defaultdict, deque
+import paho.mqtt.client as mqtt             # pip install paho-mqtt
+import numpy as np
+
+
+MAGIC = b'HLOG\x01'
+RECORD = struct.Struct('<dHI')
+
+
+class LogWriter:
+    '''Appends timestamped MQTT messages to a log file.'''
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._start = None
+        self.messages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, topic, payload, timestamp=None):
+        topic = topic.encode('utf-8')
+        payload = payload or b''
+        with self._lock:
+            now = time.monotonic() if timestamp is None else timestamp
+            if self._start is None:
+                self._start = now
+            self._file.write(RECORD.pack(now - self._start, len(topic), len(payload)))
+            self._file.write(topic)
+            self._file.write(payload)
+            self.messages += 1
+
+    def close(self):
+        self._file.close()
+
+
+def read_log(path):
+    '''Yields (timestamp, topic, payload bytes) of every message, a torn last record is ignored.'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not a message log')
+    view = memoryview(data)
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        timestamp, topic_length, payload_length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        topic = bytes(view[offset:offset + topic_length]).decode('utf-8')
+        offset += topic_length
+        if offset + payload_length > len(data):
+            break           # torn last record of an interrupted recording
+        yield timestamp, topic, bytes(view[offset:offset + payload_length])
+        offset += payload_length
+
+
+def record(path, host='localhost', port=1883, user='', password='', topics=('hermes/#', 'rhasspy/#'), seconds=None):
+    '''Records all messages of topics until seconds have passed or Ctrl+C.'''
+    writer = LogWriter(path)
+    client = mqtt.Client()
+    client.username_pw_set(user, password=password)
+    client.on_connect = lambda client, userdata, flags, rc: client.subscribe([(topic, 0) for topic in topics])
+    client.on_message = lambda client, userdata, msg: writer.write(msg.topic, msg.payload)
+    client.connect(host, port)
+    client.loop_start()
+    try:
+        start = time.monotonic()
+        while seconds is None or time.monotonic() - start < seconds:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        writer.close()
+    print(f'Recorded {writer.messages} messages to {path}')
+
+
+class FakeMessage:
+    __slots__ = ('topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+
+
+class FakeMQTTClient:
+    '''In-process stand-in for paho's Client: no network, messages are delivered by the Replayer.
+
+    Publishes on subscribed topics are looped back like a real broker does, everything published is counted.
+    '''
+    def __init__(self):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.subscriptions = set()
+        self.published = defaultdict(int)
+        self.pending = deque()
+        self._connected = False
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host='localhost', port=1883, *args, **kwargs):
+        # Like paho, on_connect is called from the network loop, not from connect
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self, *args, **kwargs):
+        self._connected = False
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_start(self):
+        if not self._connected:
+            self._connected = True
+            if self.on_connect is not None:
+                self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self, *args):
+        pass
+
+    def loop_forever(self, *args, **kwargs):
+        self.loop_start()
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        topics = [topic] if isinstance(topic, str) else [t if isinstance(t, str) else t[0] for t in topic]
+        self.subscriptions.update(topics)
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def unsubscribe(self, topic, *args, **kwargs):
+        self.subscriptions.discard(topic)
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def is_subscribed(self, topic):
+        return any(mqtt.topic_matches_sub(sub, topic) for sub in self.subscriptions)
+
+    def publish(self, topic, payload=None, qos=0, retain=False, *args, **kwargs):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.published[topic] += 1
+        if self.is_subscribed(topic):
+            self.pending.append((topic, payload or b''))
+        return mqtt.MQTTMessageInfo(0)
+
+    def deliver(self, topic, payload):
+        if self.on_message is not None:
+            self.on_message(self, None, FakeMessage(topic, payload))
+
+
+def topic_group(topic):
+    # Aggregates per-session topics, e.g. rhasspy/asr/default/3/audioCaptured -> rhasspy/asr/+/+/audioCaptured
+    levels = topic.split('/')
+    if levels[0] == 'rhasspy' and len(levels) == 5:
+        return f'rhasspy/asr/+/+/{levels[4]}'
+    if levels[0] == 'hermes' and levels[1] in ('audioServer', 'hotword') and len(levels) >= 4:
+        return '/'.join(levels[:2] + ['+'] + levels[3:4])
+    if levels[0] == 'hermes' and levels[1] == 'intent':
+        return 'hermes/intent/#'
+    return topic
+
+
+class Replayer:
+    '''Feeds a message log to client.on_message at speed x real time (None: as fast as possible).
+
+    Only messages the client is subscribed to are delivered, like a real broker would. Looped back
+    publishes of the client are delivered after each message. queue is an optional WorkQueue whose
+    depth is sampled after every message. Exceptions of handlers are counted per topic group instead
+    of ending the run, the first one of each group is kept in the report.
+    '''
+    def __init__(self, client, speed=1.0, queue=None):
+        self.client = client
+        self.speed = speed
+        self.queue = queue
+        self.latencies = defaultdict(list)
+        self.depths = []
+        self.messages = 0
+        self.skipped = 0
+        self.errors = defaultdict(int)
+        self.first_errors = {}
+        self.elapsed = 0.0
+
+    def __deliver(self, topic, payload):
+        group = topic_group(topic)
+        start = time.perf_counter()
+        try:
+            self.client.deliver(topic, payload)
+        except Exception as e:
+            self.errors[group] += 1
+            self.first_errors.setdefault(group, repr(e))
+        self.latencies[group].append(time.perf_counter() - start)
+        self.messages += 1
+
+    def run(self, records):
+        self.client.loop_start()
+        started = time.perf_counter()
+        first = None
+        for timestamp, topic, payload in records:
+            if first is None:
+                first = timestamp
+            if self.speed:
+                delay = (timestamp - first) / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            if self.client.is_subscribed(topic):
+                self.__deliver(topic, payload)
+            else:
+                self.skipped += 1
+            while self.client.pending:
+                self.__deliver(*self.client.pending.popleft())
+            if self.queue is not None:
+                self.depths.append(self.queue.depth)
+        self.elapsed = time.perf_counter() - started
+        return self.report()
+
+    def report(self):
+        report = {
+            'messages': self.messages,
+            'skipped': self.skipped,
+            'seconds': self.elapsed,
+            'messages_per_sec': self.messages / self.elapsed if self.elapsed > 0 else 0.0,
+            'errors': sum(self.errors.values()),
+            'handlers': {},
+        }
+        for group, latencies in sorted(self.latencies.items()):
+            latencies = np.array(latencies)
+            report['handlers'][group] = {
+                'count': len(latencies),
+                'errors': self.errors.get(group, 0),
+                'first_error': self.first_errors.get(group),
+                'p50': float(np.percentile(latencies, 50)),
+                'p95': float(np.percentile(latencies, 95)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max()),
+                # Counts per decade 1us, 10us, ..., 1s
+                'histogram': np.histogram(latencies, bins=[0, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, np.inf])[0].tolist(),
+            }
+        if self.queue is not None:
+            depths = np.array(self.depths or [0])
+            report['queue'] = {
+                'max_depth': int(depths.max()),
+                'mean_depth': float(depths.mean()),
+                # Growth of the queue over the run, in items per 1000 messages
+                'growth': float(np.polyfit(np.arange(len(depths)), depths, 1)[0] * 1000) if len(depths) > 1 else 0.0,
+                **self.queue.stats(),
+            }
+        return report
+
+
+def print_report(report):
+    print(f"{report['messages']} messages ({report['skipped']} not subscribed) in {report['seconds']:.2f}s: "
+          f"{report['messages_per_sec']:.0f} msg/s, {report['errors']} handler errors")
+    print(f"{'handler':45s} {'count':>7s} {'p50 us':>9s} {'p95 us':>9s} {'p99 us':>9s}   <10us <100us <1ms <10ms <100ms <1s >1s")
+    for group, stats in report['handlers'].items():
+        print(f"{group:45s} {stats['count']:7d} {stats['p50'] * 1e6:9.1f} {stats['p95'] * 1e6:9.1f} {stats['p99'] * 1e6:9.1f}   "
+              + ' '.join(str(count) for count in stats['histogram']))
+    for group, stats in report['handlers'].items():
+        if stats['errors']:
+            print(f"Errors in {group}: {stats['errors']}, first: {stats['first_error']}")
+    if 'queue' in report:
+        print('Queue:', report['queue'])
+    for histogram in report.get('metrics', {}).get('histograms', []):
+        if histogram['count']:
+            print(f"{histogram['name']:35s} {histogram['labels'].get('stage', ''):22s} "
+                  f"n={histogram['count']:6d} mean {histogram['mean'] * 1000:8.2f} ms")
+
+
+def synthesize(path, sessions=100, audio_path=None, site_ids=('default',), gap=1.0):
+    '''Writes a log of hotword -> ASR -> NLU sessions, with audio files of audio_path (or noise) as audioCaptured.'''
+    if audio_path:
+        audio = [open(os.path.join(audio_path, f), 'rb').read() for f in sorted(os.listdir(audio_path)) if f.endswith('.wav')]
+    else:
+        rng = np.random.default_rng(0)
+        audio = [(rng.standard_normal(32000) * 3000).astype('<i2').tobytes()]
+
+    with LogWriter(path) as writer:
+        for i in range(sessions):
+            t = i * gap
+            site_id = site_ids[i % len(site_ids)]
+            session_id = str(i)
+            parsed = json.dumps({'input': 'sit', 'intent': {'intentName': 'Sit', 'confidenceScore': 1.0},
+                                 'siteId': site_id, 'sessionId': session_id, 'slots': []}).encode()
+            writer.write('hermes/hotword/default/detected', json.dumps({'siteId': site_id, 'modelId': 'default'}).encode(), t)
+            writer.write('hermes/asr/startListening', json.dumps({'siteId': site_id, 'sessionId': session_id}).encode(), t + 0.01)
+            writer.write(f'rhasspy/asr/{site_id}/{session_id}/audioCaptured', audio[i % len(audio)], t + 0.5)
+            writer.write('hermes/asr/textCaptured', json.dumps({'text': 'sit', 'siteId': site_id, 'sessionId': session_id}).encode(), t + 0.5)
+            writer.write('hermes/nlu/intentParsed', parsed, t + 0.55)
+            writer.write('hermes/intent/Sit', parsed, t + 0.55)
+    print(f'Wrote {writer.messages} messages of {sessions} sessions to {path}')
+
+
+def replay_broker(args, records):
+    from broker import Broker
+
+    def callback(signal):
+        if args.emotion:
+            analyser.predict(signal=signal)
+        elif args.work_ms:
+            time.sleep(args.work_ms / 1000)
+
+    if args.emotion:
+        from sentiment import EmotionAnalyser
+        analyser = EmotionAnalyser(categorial_output=True, show_confidence=False, warmup=True)
+
+    metrics = None
+    if args.metrics:
+        from metrics import Metrics
+        metrics = Metrics()
+
+    client = FakeMQTTClient()
+    broker = Broker(audio_callback=callback, workers=args.workers, queue_size=args.queue_size, client=client, metrics=metrics)
+    report = Replayer(client, args.speed, broker.audio_queue).run(records)
+    broker.audio_queue.close()
+    report['sessions'] = broker.session_stats()
+    if metrics is not None:
+        report['metrics'] = metrics.to_dict()
+    return report
+
+
+def replay_wakeword(args, records):
+    import getWAVafterWakeword
+
+    client = FakeMQTTClient()
+    getWAVafterWakeword.subscribe(client)
+    return Replayer(client, args.speed).run(records)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record and replay Hermes MQTT traffic')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rec = commands.add_parser('record', help='Record hermes/# and rhasspy/# of a live MQTT broker')
+    rec.add_argument('-o', '--output', type=str, required=True)
+    rec.add_argument('--host', type=str, default='localhost')
+    rec.add_argument('--port', type=int, default=1883)
+    rec.add_argument('--seconds', type=float, default=None, help='Stop after this many seconds (default: Ctrl+C)')
+
+    syn = commands.add_parser('synth', help='Write a synthetic log of complete sessions')
+    syn.add_argument('-o', '--output', type=str, required=True)
+    syn.add_argument('-n', '--sessions', type=int, default=100)
+    syn.add_argument('-a', '--audio', type=str, default=None, help='Folder of WAV files used as audioCaptured')
+    syn.add_argument('-s', '--sites', type=int, default=1)
+    syn.add_argument('-g', '--gap', type=float, default=1.0, help='Seconds between sessions')
+
+    rep = commands.add_parser('replay', help='Replay a log without network')
+    rep.add_argument('log', type=str)
+    rep.add_argument('--speed', type=str, default='1', help='Multiple of real time, or "max"')
+    rep.add_argument('--target', choices=['broker', 'wakeword'], default='broker')
+    rep.add_argument('-w', '--workers', type=int, default=1)
+    rep.add_argument('-q', '--queue-size', type=int, default=8)
+    rep.add_argument('--work-ms', type=float, default=0.0, help='Simulated audio_callback time in ms')
+    rep.add_argument('--emotion', action='store_true', help='Run the real EmotionAnalyser as audio_callback')
+    rep.add_argument('--metrics', action='store_true', help='Trace stage latencies with metrics.Metrics')
+    rep.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.output, args.host, args.port, seconds=args.seconds)
+    elif args.command == 'synth':
+        synthesize(args.output, args.sessions, args.audio, [f'site-{i}' for i in range(args.sites)] if args.sites > 1 else ('default',), args.gap)
+    else:
+        args.speed = None if args.speed == 'max' else float(args.speed)
+        records = list(read_log(args.log))
+        report = (replay_broker if args.target == 'broker' else replay_wakeword)(args, records)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_report(report)
@@ -9,84 +9,181 @@ Source: wav2vec 2.0 for speech emotion recognition
 """
 
 import os
-import audeer
-import audonnx
-import audinterface
-import pandas as pd
+import math
+import time
+import itertools
+import importlib
 import pickle
-import paho.mqtt.client as mqtt             # pip install paho-mqtt
+import numpy as np
 
-from broker import Broker
+from embedding_cache import EmbeddingCache, file_fingerprint
+from shards import ShardDataset
 
 
 class EmotionAnalyser:
-    def __init__(self, categorial_output=True, show_confidence=True, model_root='model', cache_root='cache', sampling_rate=16000, num_workers=1):
+    MODEL_URL = 'https://zenodo.org/record/6221127/files/w2v2-L-robust-12.6bc4a7fd-1.1.0.zip'
+
+    def __init__(self, categorial_output=True, show_confidence=True, model_root='model', cache_root='cache', sampling_rate=16000, num_workers=1,
+                 lazy=False, warmup=True, quantized=False, cache_embeddings=False, cache_items=1024, cache_disk_bytes=1 << 30,
+                 metrics=None):
         self.model_root = model_root
         self.cache_root = cache_root
         self.sampling_rate = sampling_rate
         self.categorial_output = categorial_output
         self.num_workers = num_workers
         self.show_confidence = show_confidence
-
-        self.model = self.__load_model()
-        self.interface = self.__load_interface()
-        self.classifier = self.__load_classifier() if self.categorial_output else None
+        self.output_name = 'hidden_states' if self.categorial_output else 'logits'
+        self.quantized = quantized
+        self.cache_embeddings = cache_embeddings
+        self.cache_items = cache_items
+        self.cache_disk_bytes = cache_disk_bytes
+        # Optional metrics.Metrics for inference times and emotion counts
+        self.metrics = metrics
 
         self.logits = ('arousal', 'dominance', 'valence')
         self.emotions = ('anger', 'boredom', 'disgust', 'fear', 'happiness', 'neutral', 'sadness')
 
+        # Seconds spent in each startup phase, see startup_report()
+        self.startup_times = {}
+        self.session = None
+        self.classifier = None
+        self.embedding_cache = None
+        self._interface = None
+        self._warming_up = False
+        self._resamplers = {}
+
+        if not lazy:
+            self.load(warmup=warmup)
+
+    def load(self, warmup=True):
+        '''Imports the runtime, loads the (pre-optimized) ONNX graph and the classifier, optionally runs a warmup inference.'''
+        if self.session is not None:
+            return
+
+        # Heavy imports are deferred to here so that importing this module stays cheap
+        start = time.perf_counter()
+        importlib.import_module('onnxruntime')
+        if self.categorial_output:
+            importlib.import_module('sklearn')
+        self.startup_times['import'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.session = self.__load_session()
+        self.classifier = self.__load_classifier() if self.categorial_output else None
+        if self.cache_embeddings:
+            # Features only depend on the audio and the wav2vec2 model, not on the classifier head
+            self.embedding_cache = EmbeddingCache(
+                self.__cache_path('embeddings'),
+                fingerprint=f'{file_fingerprint(self.__model_path(self.quantized))}:{self.output_name}',
+                max_items=self.cache_items,
+                max_disk_bytes=self.cache_disk_bytes,
+            )
+        self.startup_times['load'] = time.perf_counter() - start
+
+        if warmup:
+            start = time.perf_counter()
+            noise = np.random.default_rng(0).standard_normal(self.sampling_rate).astype(np.float32) * 0.01
+            self._warming_up = True
+            try:
+                self.predict(signal=noise)
+            finally:
+                self._warming_up = False
+            self.startup_times['warmup'] = time.perf_counter() - start
+
+    def startup_report(self):
+        '''Duration of every startup phase measured so far, first_inference only after the first real prediction.'''
+        phases = ('import', 'load', 'warmup', 'first_inference')
+        return ', '.join(f'{phase}: {self.startup_times[phase] * 1000:.0f} ms' for phase in phases if phase in self.startup_times)
+
+    @property
+    def interface(self):
+        if self._interface is None:
+            self._interface = self.__load_interface()
+        return self._interface
 
     def __cache_path(self, file):
         return os.path.join(self.cache_root, file)
 
-    def __load_model(self):
-        audeer.mkdir(self.cache_root)
+    def __model_path(self, quantized=False):
+        return os.path.join(self.model_root, 'model.int8.onnx' if quantized else 'model.onnx')
+
+    def __quantize_model(self, src_path, dst_path):
+        # Dynamic int8 quantization of the transformer matmuls, the conv feature encoder stays fp32
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        print(f'Quantizing {src_path} -> {dst_path}')
+        quantize_dynamic(
+            src_path,
+            dst_path,
+            op_types_to_quantize=['MatMul', 'Gemm'],
+            weight_type=QuantType.QInt8,
+        )
 
-        url = 'https://zenodo.org/record/6221127/files/w2v2-L-robust-12.6bc4a7fd-1.1.0.zip'
+    def __download_model(self):
+        import audeer
+
+        audeer.mkdir(self.cache_root)
         dst_path = self.__cache_path('model.zip')
 
         if not os.path.exists(dst_path):
             audeer.download_url(
-                url, 
-                dst_path, 
-                verbose=True,
-            )
-            
-        if not os.path.exists(self.model_root):
-            audeer.extract_archive(
-                dst_path, 
-                self.model_root, 
+                self.MODEL_URL,
+                dst_path,
                 verbose=True,
             )
 
-        return audonnx.load(self.model_root)
+        audeer.extract_archive(
+            dst_path,
+            self.model_root,
+            verbose=True,
+        )
 
-    def __load_interface(self):
-        if self.categorial_output:
-            return audinterface.Feature(
-                self.model.outputs['hidden_states'].labels,
-                process_func=self.model,
-                process_func_args={
-                    'output_names': 'hidden_states',
-                },
-                sampling_rate=16000,    
-                resample=True,
-                num_workers=self.num_workers,
-                verbose=True,
-            )
+    def __load_session(self):
+        import onnxruntime
 
+        model_path = self.__model_path(self.quantized)
+        fp32_path = self.__model_path()
+        if not os.path.exists(fp32_path):
+            self.__download_model()
+        if self.quantized and (not os.path.exists(model_path) or os.path.getmtime(model_path) < os.path.getmtime(fp32_path)):
+            self.__quantize_model(fp32_path, model_path)
+
+        # Graph optimization runs once, the optimized graph is serialized next to the model and reused afterwards
+        root, ext = os.path.splitext(model_path)
+        optimized_path = f'{root}.opt{ext}'
+        options = onnxruntime.SessionOptions()
+        if os.path.exists(optimized_path) and os.path.getmtime(optimized_path) >= os.path.getmtime(model_path):
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            path = optimized_path
         else:
-            return audinterface.Feature(
-                self.model.outputs['logits'].labels,
-                process_func=self.model,
-                process_func_args={
-                    'output_names': 'logits',
-                },
-                sampling_rate=self.sampling_rate,
-                resample=True,    
-                num_workers=self.num_workers,
-                verbose=True,
-            )
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+            options.optimized_model_filepath = optimized_path
+            path = model_path
+
+        return onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def __labels(self):
+        if self.output_name == 'logits':
+            return list(self.logits)
+        # Same default labels audonnx generates for unlabelled outputs
+        dim = next(output.shape[-1] for output in self.session.get_outputs() if output.name == self.output_name)
+        return [f'{self.output_name}-{i}' for i in range(dim)]
+
+    def __process(self, signal, sampling_rate):
+        return self.__run([signal.reshape(-1)])[0]
+
+    def __load_interface(self):
+        import audinterface
+
+        self.load(warmup=False)
+        return audinterface.Feature(
+            self.__labels(),
+            process_func=self.__process,
+            sampling_rate=self.sampling_rate,
+            resample=True,
+            num_workers=self.num_workers,
+            verbose=True,
+        )
 
     def __load_classifier(self):
         path = self.__cache_path('emotion_categorial_model.pkl')
@@ -98,27 +195,178 @@ class EmotionAnalyser:
         else:
             raise RuntimeError('No categorial model found! File cache/emotion_categorial_model.pkl required')
 
-    def predict(self, signal=None, file=None):
-        if signal is None:
-            features = self.interface.process_file(file)
-        else:
-            features = self.interface.process_signal(signal, sampling_rate=16000)
+    def __run(self, signals):
+        # One ONNX call for the whole batch, all signals must have the same length
+        session = self.session
+        batch = np.stack([np.asarray(signal, dtype=np.float32) for signal in signals])
+        return session.run([self.output_name], {session.get_inputs()[0].name: batch})[0]
+
+    def __run_grouped(self, signals):
+        # The model has no attention mask and mean-pools over time, so zero padding would change the
+        # features of the shorter signals: only signals of exactly the same length share a model call
+        groups = {}
+        for i, signal in enumerate(signals):
+            groups.setdefault(len(signal), []).append(i)
+        features = [None] * len(signals)
+        for indices in groups.values():
+            for i, row in zip(indices, self.__run([signals[i] for i in indices])):
+                features[i] = row[np.newaxis]
+        return np.concatenate(features)
+
+    def __format(self, features):
         if self.categorial_output:
             if self.show_confidence:
-                proba = dict(zip(self.emotions, self.classifier.predict_proba(features)[0]))
-                pred = max(proba, key=proba.get)
-                return {"emotion": pred, "confidence": proba[pred]}
+                results = []
+                for row in self.classifier.predict_proba(features):
+                    proba = dict(zip(self.emotions, row))
+                    pred = max(proba, key=proba.get)
+                    results.append({"emotion": pred, "confidence": proba[pred]})
+                return results
             else:
-                return self.classifier.predict(features)[0]
+                return list(self.classifier.predict(features))
         else:
-            return dict(zip(self.logits, features.values.tolist()[0]))
+            return [dict(zip(self.logits, row)) for row in np.asarray(features).tolist()]
+
+    def __record(self, results, start, call):
+        if self.metrics is None or self._warming_up:
+            return
+        self.metrics.observe('enamour_emotion_inference_seconds', time.perf_counter() - start, call=call)
+        if self.categorial_output:
+            for result in results:
+                self.metrics.inc('enamour_emotion_total', emotion=result['emotion'] if isinstance(result, dict) else str(result))
+
+    def __resampler(self, sampling_rate):
+        # Polyphase factors and the FIR design resample_poly would otherwise redo on every call
+        if sampling_rate not in self._resamplers:
+            from scipy.signal import firwin
+
+            g = math.gcd(int(sampling_rate), self.sampling_rate)
+            up, down = self.sampling_rate // g, int(sampling_rate) // g
+            max_rate = max(up, down)
+            fir = firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0)).astype(np.float32)
+            self._resamplers[sampling_rate] = (up, down, fir)
+        return self._resamplers[sampling_rate]
+
+    def features(self, signal, sampling_rate=16000):
+        '''Lean inference path: runs a float32 signal straight through the ONNX session.
+
+        Bypasses audinterface and pandas, resamples with a cached polyphase filter if needed and returns
+        the model output (hidden_states or logits) as ndarray of shape (1, dim).
+        '''
+        self.load(warmup=False)
+        signal = np.asarray(signal, dtype=np.float32).reshape(-1)
+        if sampling_rate != self.sampling_rate:
+            from scipy.signal import resample_poly
+
+            up, down, fir = self.__resampler(sampling_rate)
+            signal = resample_poly(signal, up, down, window=fir).astype(np.float32)
+
+        cache = None if self._warming_up else self.embedding_cache
+        if cache is not None:
+            key = cache.key(signal)
+            features = cache.get(key)
+            if features is not None:
+                return features
+
+        features = self.__run([signal])
+        if cache is not None:
+            cache.put(key, features)
+        return features
+
+    def __file_features(self, file):
+        cache = self.embedding_cache
+        if cache is not None:
+            with open(file, 'rb') as f:
+                key = cache.key(f.read())
+            features = cache.get(key)
+            if features is not None:
+                return features
+
+        features = self.interface.process_file(file)
+        if cache is not None:
+            features = features.values
+            cache.put(key, features)
+        return features
+
+    def predict(self, signal=None, file=None, sampling_rate=16000):
+        first = 'first_inference' not in self.startup_times and not self._warming_up
+        start = time.perf_counter()
+
+        if signal is None:
+            features = self.__file_features(file)
+        else:
+            features = self.features(signal, sampling_rate=sampling_rate)
+        result = self.__format(features)[0]
+        self.__record((result,), start, 'predict')
+
+        if first:
+            self.startup_times['first_inference'] = time.perf_counter() - start
+        return result
+
+    def predict_batch(self, signals):
+        '''Predicts several 16 kHz signals with one model call per distinct length, returns one result per signal.
+
+        Signals are never zero padded, so every result equals predict() on the same signal (and is cached
+        under the same key). Batching only pays off for signals of exactly the same length.
+        '''
+        self.load(warmup=False)
+        first = 'first_inference' not in self.startup_times and not self._warming_up
+        start = time.perf_counter()
+        cache = self.embedding_cache
+        if cache is None:
+            results = self.__format(self.__run_grouped(signals))
+        else:
+            keys = [cache.key(signal) for signal in signals]
+            features = [cache.get(key) for key in keys]
+            missing = [i for i, f in enumerate(features) if f is None]
+            if missing:
+                computed = self.__run_grouped([signals[i] for i in missing])
+                for i, row in zip(missing, computed):
+                    features[i] = row[np.newaxis]
+                    cache.put(keys[i], features[i])
+            results = self.__format(np.concatenate(features))
+        self.__record(results, start, 'predict_batch')
+
+        if first:
+            self.startup_times['first_inference'] = time.perf_counter() - start
+        return results
+
+    def predict_shards(self, folder, batch_size=8):
+        '''Yields (name, result) for every clip of a shard folder written by audioaugment --format shards.
+
+        Clips are read straight from the memory-mapped shards. 16 kHz clips are sorted by their indexed length
+        and clips of the same length are predicted in batches of up to batch_size (predict_batch never pads),
+        clips at other rates one by one through the resampling path. Results are yielded in shard order.
+        '''
+        clips = [(reader, i) for reader in ShardDataset(folder).readers for i in range(len(reader))]
+        index = [reader.clips[i] for reader, i in clips]
+        results = [None] * len(clips)
+
+        def signal(j):
+            reader, i = clips[j]
+            return reader[i][2].astype(np.float32) / 32768.0
+
+        batched = sorted((j for j, clip in enumerate(index) if clip['samplerate'] == self.sampling_rate),
+                         key=lambda j: index[j]['length'])
+        for _, group in itertools.groupby(batched, key=lambda j: index[j]['length']):
+            group = list(group)
+            for start in range(0, len(group), batch_size):
+                chunk = group[start:start + batch_size]
+                for j, result in zip(chunk, self.predict_batch([signal(j) for j in chunk])):
+                    results[j] = result
+
+        for j in range(len(clips)):
+            if results[j] is None:
+                results[j] = self.predict(signal=signal(j), sampling_rate=index[j]['samplerate'])
+            yield index[j]['name'], results[j]
 
 
 if __name__ == '__main__':
     import glob
+    from broker import Broker
 
     files = glob.glob("data/02-M/*.wav")
-    ea = EmotionAnalyser(categorial_output=True, show_confidence=True)
+    ea = EmotionAnalyser(categorial_output=True, show_confidence=True, cache_embeddings=True)
 
     broker = Broker()
 
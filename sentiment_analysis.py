@@ -1,7 +1,12 @@
 import flair
-from typing import List, DefaultDict
+from typing import Dict, Iterator, List, DefaultDict, Optional, Tuple
 import os
+import json
+import zlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict
+from dataset_cache import default_cache, normalize
 
 
 def get_sentences_from_txt(filepath: str) -> List[str]:
@@ -10,46 +15,197 @@ def get_sentences_from_txt(filepath: str) -> List[str]:
     :param filepath: filepath where the dataset is saved
     :return: List that contains the extracted sentences from the dataset file (removed intents, white spacey, empty lines
     """
-    result = []
-    with open(filepath, 'r') as file:
-        for line in file:
-            if "[" not in line:
-                temp = line.rstrip()
-                if not temp == '':
-                    result.append(temp)
-    return result
+    # Parsed once and kept in the compiled dataset cache until the file changes
+    return list(default_cache().get(filepath).sentences)
+
+
+class SentimentCache:
+    """persistent sentiment results keyed by model identity and normalized sentence (sqlite)"""
+
+    def __init__(self, path: str, model_name: str):
+        self.model_name = model_name
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Shard workers share the file, wait for each other's writes instead of failing
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sentiments "
+                        "(model TEXT, text TEXT, label TEXT, confidence REAL, PRIMARY KEY (model, text))")
+
+    def get_many(self, texts: List[str]) -> Dict[str, Tuple[str, float]]:
+        """cached [label, confidence] of all texts that have been scored before
+
+        :param texts: normalized sentences
+        :return: Dictionary with the cached texts as key and (label, confidence) as value
+        """
+        result = {}
+        for start in range(0, len(texts), 500):
+            chunk = texts[start:start + 500]
+            rows = self.db.execute(
+                f"SELECT text, label, confidence FROM sentiments WHERE model = ? AND text IN ({','.join('?' * len(chunk))})",
+                [self.model_name, *chunk])
+            result.update((text, (label, confidence)) for text, label, confidence in rows)
+        return result
+
+    def put_many(self, results: Dict[str, Tuple[str, float]]):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO sentiments VALUES (?, ?, ?, ?)",
+                                [(self.model_name, text, label, confidence) for text, (label, confidence) in results.items()])
+
+    def close(self):
+        self.db.close()
+
 
+def score_sentences(data: List[str], model, batch_size: int = 32, cache_path: Optional[str] = None,
+                    model_name: str = 'en-sentiment') -> Iterator[Dict[str, Tuple[str, float]]]:
+    """score sentences with a pretrained flair model, yielding results as soon as a mini batch is done
 
-def predict_sentiments(data: List[str], model) -> DefaultDict:
-    """predict the sentiments for the data with a pretrained flair model
+    Sentences are normalized and deduplicated, already cached sentences are not scored again and the rest
+    is predicted in mini batches.
 
     :param data: Data for that the sentiments should be predicted
     :param model: Flair Text Classifier model that is used for sentiment analysis
+    :param batch_size: mini batch size of the flair prediction
+    :param cache_path: path of the sqlite result cache, no caching if None
+    :param model_name: identity of the model in the cache, results of different models are kept apart
+    :return: Iterator of dictionaries with the sentences as key and (sentiment, confidence) as value
+    """
+    unique = defaultdict(list)
+    for sentence in data:
+        unique[normalize(sentence)].append(sentence)
+
+    def fan_out(scores):
+        return {sentence: value for text, value in scores.items() for sentence in unique[text]}
+
+    cache = SentimentCache(cache_path, model_name) if cache_path else None
+    try:
+        cached = cache.get_many(list(unique)) if cache is not None else {}
+        if cached:
+            yield fan_out(cached)
+
+        missing = [text for text in unique if text not in cached]
+        for start in range(0, len(missing), batch_size):
+            texts = missing[start:start + batch_size]
+            sentences = [flair.data.Sentence(unique[text][0]) for text in texts]
+            model.predict(sentences, mini_batch_size=batch_size)
+            batch_scores = {}
+            for text, s in zip(texts, sentences):
+                label = s.labels[0].to_dict()
+                batch_scores[text] = (label['value'], label['confidence'])
+            if cache is not None:
+                cache.put_many(batch_scores)
+            yield fan_out(batch_scores)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def predict_sentiments(data: List[str], model, batch_size: int = 32, cache_path: Optional[str] = None,
+                       model_name: str = 'en-sentiment') -> DefaultDict:
+    """predict the sentiments for the data with a pretrained flair model, see score_sentences
+
     :return: Dictionary with the sentences as key and the predicted sentiment as value
     """
     res_dict = defaultdict(list)
+    for scores in score_sentences(data, model, batch_size, cache_path, model_name):
+        for sentence, (pred_value, confidences) in scores.items():
+            res_dict[sentence] = [pred_value, confidences]
+    return res_dict
 
-    for sentence in data:
-        s = flair.data.Sentence(sentence)
-        model.predict(s)
-        pred_value = s.labels[0].to_dict()['value']
-        confidences = s.labels[0].to_dict()['confidence']
-        result = [pred_value, confidences]
-        res_dict[sentence] = result
 
-    return res_dict
+def read_jsonl(path: str) -> Dict[str, Tuple[str, float]]:
+    """read the sentiments of a JSON Lines file, a torn last line (crashed run) is cut off the file
+
+    :param path: path of the jsonl file
+    :return: Dictionary with the sentences as key and (sentiment, confidence) as value
+    """
+    result = {}
+    if not os.path.exists(path):
+        return result
+
+    valid_bytes = 0
+    with open(path, 'rb') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            result[record['sentence']] = (record['sentiment'], record['confidence'])
+            valid_bytes += len(line)
+
+    if valid_bytes != os.path.getsize(path):
+        with open(path, 'r+b') as file:
+            file.truncate(valid_bytes)
+    return result
+
+
+def append_jsonl(file, scores: Dict[str, Tuple[str, float]]):
+    """append sentiments to an open JSON Lines file and flush them to disk
+
+    :param file: file opened for appending
+    :param scores: Dictionary with the sentences as key and (sentiment, confidence) as value
+    """
+    for sentence, (pred_value, confidence) in scores.items():
+        file.write(json.dumps({'sentence': sentence, 'sentiment': pred_value, 'confidence': confidence}) + '\n')
+    file.flush()
+
+
+def shard_of(sentence: str, num_shards: int) -> int:
+    # Duplicates after normalization always land in the same shard
+    return zlib.crc32(normalize(sentence).encode()) % num_shards
 
 
-def write_dict_to_json(sentiments: DefaultDict, save_path: str):
-    """writes a dictionary into a json file
+def score_shard(shard: int, num_shards: int, data: List[str], part_path: str, model_name: str = 'en-sentiment',
+                batch_size: int = 32, cache_path: Optional[str] = None) -> int:
+    """score one shard of the data into its own jsonl part file, resuming after the last written line
 
-    :param sentiments: dictionary that contains the sentences with its sentiments and confidence
-    :param save_path: path from the json file
-    :return:
+    Loads the flair model once for the whole shard.
+
+    :return: number of sentences scored in this run
     """
-    with open(save_path, "w") as file:
-        for key, value in sentiments.items():
-            file.write(f"{key} \n sentiment: {value[0]} \t confidence. {value[1]}\n\n\n")
+    done = read_jsonl(part_path)
+    todo = [sentence for sentence in data if shard_of(sentence, num_shards) == shard and sentence not in done]
+    if not todo:
+        return 0
+
+    model = flair.models.TextClassifier.load(model_name)
+    with open(part_path, 'a') as file:
+        for scores in score_sentences(todo, model, batch_size, cache_path, model_name):
+            append_jsonl(file, scores)
+    return len(todo)
+
+
+def score_to_jsonl(data: List[str], save_path: str, model_name: str = 'en-sentiment', workers: int = 1,
+                   batch_size: int = 32, cache_path: Optional[str] = None):
+    """score the data with N worker processes and stream the results into a JSON Lines file
+
+    Every worker streams its shard into <save_path>.part<i>. A crashed run resumes from the parts, once all
+    shards are done they are merged into save_path in data order and removed.
+
+    :param data: Data for that the sentiments should be predicted
+    :param save_path: path of the resulting jsonl file
+    :param model_name: name of the pretrained flair model
+    :param workers: number of worker processes (and shards)
+    :param batch_size: mini batch size of the flair prediction
+    :param cache_path: path of the sqlite result cache, no caching if None
+    """
+    parts = [f'{save_path}.part{i}' for i in range(workers)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(score_shard, i, workers, data, part, model_name, batch_size, cache_path)
+                       for i, part in enumerate(parts)]
+            for future in futures:
+                future.result()
+    else:
+        score_shard(0, 1, data, parts[0], model_name, batch_size, cache_path)
+
+    merged = {}
+    for part in parts:
+        merged.update(read_jsonl(part))
+    tmp_path = f'{save_path}.tmp'
+    with open(tmp_path, 'w') as file:
+        append_jsonl(file, {sentence: merged[sentence] for sentence in dict.fromkeys(data) if sentence in merged})
+    os.replace(tmp_path, save_path)
+    for part in parts:
+        os.remove(part)
 
 
 if __name__ == "__main__":
@@ -59,10 +215,9 @@ if __name__ == "__main__":
 
     root_path = os.path.dirname(os.path.abspath(__file__))
     dataset_path = os.path.join(root_path, "dataset/sentences.ini")
-    save_path = os.path.join(root_path, 'dataset/sentiments_new.json')
-
-    # define pretrained flair model
-    flair_sentiment = flair.models.TextClassifier.load('en-sentiment')
+    save_path = os.path.join(root_path, 'dataset/sentiments_new.jsonl')
+    cache_path = os.path.join(root_path, 'cache/sentiments.sqlite')
+    workers = 1
 
     """
     Data generation and prediction
@@ -70,8 +225,5 @@ if __name__ == "__main__":
 
     data = get_sentences_from_txt(dataset_path)
 
-    sentiments = predict_sentiments(data, flair_sentiment)
-
-    write_dict_to_json(sentiments, save_path)
-
-    x = 5
+    # Sentiments are streamed into dataset/sentiments_new.jsonl, a crashed run resumes where it stopped
+    score_to_jsonl(data, save_path, model_name='en-sentiment', workers=workers, batch_size=32, cache_path=cache_path)
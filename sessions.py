@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Session manager for many sites on one MQTT broker
+
+Sessions are compact __slots__ objects keyed by (siteId, sessionId). Finished sessions are removed right away,
+sessions without an answer are removed by expire(). Memory per session:
+
+python3 sessions.py --sessions 10000
+"""
+
+import sys
+import time
+import argparse
+import threading
+import tracemalloc
+
+
+class Session:
+    '''One ASR/NLU session of a site, file and target_intent are only set for evaluation sessions.'''
+    __slots__ = ('site_id', 'session_id', 'file', 'target_intent', 'sentence', 'intent', 'error', 'started', 'audio_done',
+                 'finished')
+
+    def __init__(self, site_id, session_id, file=None, target_intent=None):
+        self.site_id = site_id
+        self.session_id = session_id
+        self.file = file
+        self.target_intent = target_intent
+        self.sentence = ''
+        self.intent = None
+        self.error = None           # e.g. 'asr' if the session ended with hermes/error/asr
+        self.started = time.perf_counter()
+        self.audio_done = None      # end of streamed audio, if audio is sent by us
+        self.finished = None
+
+    @property
+    def key(self):
+        return self.site_id, self.session_id
+
+
+class SessionManager:
+    '''Active sessions by (siteId, sessionId), changed is notified whenever a session ends.
+
+    changed is re-entrant, callers can hold it to record a session's result before finish() wakes waiters.
+    '''
+    def __init__(self):
+        self._sessions = {}
+        self.changed = threading.Condition(threading.RLock())
+        self.started = 0
+        self.finished = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def start(self, site_id, session_id, file=None, target_intent=None):
+        session = Session(site_id, session_id, file, target_intent)
+        with self.changed:
+            self._sessions[session.key] = session
+            self.started += 1
+        return session
+
+    def get(self, site_id, session_id):
+        return self._sessions.get((site_id, session_id))
+
+    def finish(self, session):
+        '''Removes session, returns False if it had already ended (or expired).'''
+        with self.changed:
+            if self._sessions.pop(session.key, None) is None:
+                return False
+            session.finished = time.perf_counter()
+            self.finished += 1
+            self.changed.notify_all()
+        return True
+
+    def expire(self, timeout, predicate=None):
+        '''Removes and returns the sessions without an answer timeout seconds after their start (or the end of
+        their streamed audio), only those matching predicate.'''
+        now = time.perf_counter()
+        with self.changed:
+            expired = [s for s in self._sessions.values()
+                       if now - (s.audio_done or s.started) > timeout and (predicate is None or predicate(s))]
+            for session in expired:
+                del self._sessions[session.key]
+            if expired:
+                self.expired += len(expired)
+                self.changed.notify_all()
+        return expired
+
+    def count(self, predicate=None):
+        if predicate is None:
+            return len(self._sessions)
+        return sum(1 for s in list(self._sessions.values()) if predicate(s))
+
+    def memory_usage(self):
+        '''Approximate bytes held per active session: slots object, its key and attribute values and the table entry.'''
+        sessions = list(self._sessions.values())
+        if not sessions:
+            return 0
+        total = sys.getsizeof(self._sessions)
+        for s in sessions:
+            total += sys.getsizeof(s) + sys.getsizeof(s.key) + sum(sys.getsizeof(getattr(s, slot)) for slot in Session.__slots__)
+        return total / len(sessions)
+
+    def stats(self):
+        return {
+            'active': len(self._sessions),
+            'started': self.started,
+            'finished': self.finished,
+            'expired': self.expired,
+            'bytes_per_session': self.memory_usage(),
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure memory per active session')
+    parser.add_argument('-n', '--sessions', type=int, default=10000,
+                        help='Number of concurrently active sessions')
+    parser.add_argument('-s', '--sites', type=int, default=500,
+                        help='Number of sites the sessions are spread over')
+    args = parser.parse_args()
+
+    manager = SessionManager()
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    for i in range(args.sessions):
+        manager.start(f'site-{i % args.sites}', f'session-{i}')
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'{args.sessions} sessions on {args.sites} sites: {(used - base) / args.sessions:.0f} bytes/session traced '
+          f'(incl. id strings), {manager.memory_usage():.0f} bytes/session estimated')
+    for session in manager:
+        manager.finish(session)
+    print(manager.stats())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 06/22/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Packed shard format for many short clips: one int16 PCM blob per shard plus a JSON index
+
+<folder>/shard-00000.pcm          raw little-endian int16 samples of all clips, back to back
+<folder>/shard-00000.index.json   {"clips": [{"name", "offset", "length", "samplerate"}, ...]}
+"""
+
+import os
+import glob
+import json
+import numpy as np
+
+
+INDEX_SUFFIX = '.index.json'
+
+
+def is_shard_folder(path):
+    return os.path.isdir(path) and bool(glob.glob(os.path.join(path, f'*{INDEX_SUFFIX}')))
+
+
+class ShardWriter:
+    '''Appends clips to shard files in folder, starting a new shard once max_shard_bytes is reached.
+
+    Shards of an earlier run in folder are deleted on open, so a run with fewer shards leaves none behind.
+    '''
+    def __init__(self, folder, max_shard_bytes=1 << 30):
+        self.folder = folder
+        self.max_shard_bytes = max_shard_bytes
+        self.shard = -1
+        self._file = None
+        self._clips = []
+        self._offset = 0
+        os.makedirs(folder, exist_ok=True)
+        for path in glob.glob(os.path.join(folder, f'shard-*{INDEX_SUFFIX}')) + glob.glob(os.path.join(folder, 'shard-*.pcm')):
+            os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __prefix(self):
+        return os.path.join(self.folder, f'shard-{self.shard:05d}')
+
+    def __open_next(self):
+        self.close()
+        self.shard += 1
+        self._file = open(f'{self.__prefix()}.pcm', 'wb')
+        self._clips = []
+        self._offset = 0
+
+    def write(self, name, samplerate, data):
+        if self._file is None or self._offset * 2 >= self.max_shard_bytes:
+            self.__open_next()
+
+        data = np.ascontiguousarray(data, dtype='<i2')
+        self._file.write(data.tobytes())
+        self._clips.append({'name': name, 'offset': self._offset, 'length': len(data), 'samplerate': int(samplerate)})
+        self._offset += len(data)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        with open(f'{self.__prefix()}{INDEX_SUFFIX}', 'w') as f:
+            json.dump({'dtype': '<i2', 'clips': self._clips}, f)
+
+
+class ShardReader:
+    '''Memory-mapped view on one shard, clips are sliced out of the mapping without copying.'''
+    def __init__(self, index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        self.path = index_path[:-len(INDEX_SUFFIX)]
+        self.clips = index['clips']
+        self.names = {clip['name']: i for i, clip in enumerate(self.clips)}
+        pcm_path = f'{self.path}.pcm'
+        self.data = np.memmap(pcm_path, dtype=index['dtype'], mode='r') if os.path.getsize(pcm_path) else np.zeros(0, dtype='<i2')
+
+    def __len__(self):
+        return len(self.clips)
+
+    def __getitem__(self, i):
+        '''Returns (name, samplerate, int16 view) of clip i, or of the clip called i.'''
+        clip = self.clips[self.names[i] if isinstance(i, str) else i]
+        return clip['name'], clip['samplerate'], self.data[clip['offset']:clip['offset'] + clip['length']]
+
+    def __iter__(self):
+        for i in range(len(self.clips)):
+            yield self[i]
+
+
+class ShardDataset:
+    '''All shards of a folder as one sequence of (name, samplerate, int16 view) clips.'''
+    def __init__(self, folder):
+        self.readers = [ShardReader(path) for path in sorted(glob.glob(os.path.join(folder, f'*{INDEX_SUFFIX}')))]
+
+    def __len__(self):
+        return sum(len(reader) for reader in self.readers)
+
+    def __iter__(self):
+        for reader in self.readers:
+            yield from reader
+
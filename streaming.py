@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Streaming emotion estimation over hermes/audioServer/<siteId>/audioFrame chunks during an ASR session
+"""
+
+import json
+import threading
+import numpy as np
+
+from audiobuffer import PCM16_SCALE, pcm16_view
+from workqueue import WorkQueue
+
+
+class StreamBuffer:
+    '''Growing float32 buffer of one site's current utterance, keeps the last capacity samples.'''
+    __slots__ = ('session_id', 'data', 'size', 'total', 'last_inference')
+
+    def __init__(self, session_id, capacity):
+        self.session_id = session_id
+        self.data = np.empty(capacity, dtype=np.float32)
+        self.size = 0
+        self.total = 0
+        self.last_inference = 0
+
+    def append(self, pcm):
+        n = len(pcm)
+        capacity = len(self.data)
+        if n >= capacity:
+            pcm, n = pcm[-capacity:], capacity
+        if self.size + n > capacity:
+            keep = capacity - n
+            self.data[:keep] = self.data[self.size - keep:self.size]
+            self.size = keep
+        np.multiply(pcm, PCM16_SCALE, out=self.data[self.size:self.size + n])
+        self.size += n
+        self.total += n
+
+    def tail(self, num_samples):
+        return self.data[max(0, self.size - num_samples):self.size].copy()
+
+
+class StreamingEmotionEstimator:
+    '''Runs windowed emotion inference while a site is speaking.
+
+    Every hop seconds of new audio the last window seconds are classified and published as a provisional
+    result, at the end of the session the whole utterance is classified and published as final result.
+    Inference runs on worker threads, stale provisional windows are dropped if inference falls behind.
+    '''
+    ON_EMOTION_PROVISIONAL = 'enamour/emotion/{siteId}/provisional'
+    ON_EMOTION_FINAL       = 'enamour/emotion/{siteId}/final'
+
+    def __init__(self, analyser, window=2.0, hop=0.5, min_window=1.0, max_seconds=30.0, sampling_rate=16000):
+        self.analyser = analyser
+        self.sampling_rate = sampling_rate
+        self.window = int(window * sampling_rate)
+        self.hop = int(hop * sampling_rate)
+        self.min_window = int(min_window * sampling_rate)
+        self.capacity = int(max_seconds * sampling_rate)
+        self.client = None
+
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._provisional = WorkQueue(self.__infer, workers=1, maxsize=4, overflow=WorkQueue.DROP_OLDEST, name='EmotionStream')
+        self._final = WorkQueue(self.__infer, workers=1, maxsize=64, overflow=WorkQueue.BLOCK, name='EmotionFinal')
+
+    def start(self, site_id, session_id):
+        with self._lock:
+            self._streams[site_id] = StreamBuffer(session_id, self.capacity)
+
+    def feed(self, site_id, payload):
+        stream = self._streams.get(site_id)
+        if stream is None:
+            return
+
+        stream.append(pcm16_view(payload))
+        if stream.total - stream.last_inference >= self.hop and stream.size >= self.min_window:
+            stream.last_inference = stream.total
+            self._provisional.put((site_id, stream.session_id, stream.tail(self.window), stream.total, False))
+
+    def finish(self, site_id):
+        with self._lock:
+            stream = self._streams.pop(site_id, None)
+        if stream is not None and stream.size > 0:
+            self._final.put((site_id, stream.session_id, stream.tail(stream.size), stream.total, True))
+
+    def __infer(self, item):
+        site_id, session_id, signal, total, final = item
+        result = self.analyser.predict_batch([signal])[0]
+        if isinstance(result, dict) and 'emotion' in result:
+            emotion, confidence = result['emotion'], float(result['confidence'])
+        else:
+            emotion, confidence = str(result), None
+
+        topic = (self.ON_EMOTION_FINAL if final else self.ON_EMOTION_PROVISIONAL).format(siteId=site_id)
+        message = {
+            'siteId': site_id,
+            'sessionId': session_id,
+            'emotion': emotion,
+            'confidence': confidence,
+            'final': final,
+            'audioSeconds': total / self.sampling_rate,
+        }
+        if self.client is not None:
+            self.client.publish(topic, json.dumps(message))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Date : 05/11/2022
+# @Project: ENAMOUR
+# @AUTHOR : Marcel Rinder
+
+"""
+Bounded work queue with a thread pool and a configurable overflow policy
+"""
+
+import threading
+from collections import deque
+
+
+class WorkQueue:
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    BLOCK       = 'block'
+
+    def __init__(self, handler, workers=1, maxsize=8, overflow=DROP_OLDEST, on_drop=None, name='WorkQueue'):
+        if overflow not in (self.DROP_OLDEST, self.DROP_NEWEST, self.BLOCK):
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+
+        self.handler = handler
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.on_drop = on_drop
+
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+
+        self._items = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self.__work, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._items),
+                'max_depth': self.max_depth,
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+            }
+
+    def put(self, item):
+        '''Enqueues item, returns False if item itself was dropped.'''
+        dropped = None
+        with self._cond:
+            self.submitted += 1
+            if len(self._items) >= self.maxsize:
+                if self.overflow == self.BLOCK:
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._cond.wait()
+                elif self.overflow == self.DROP_OLDEST:
+                    dropped = self._items.popleft()
+                else:
+                    dropped = item
+
+            if dropped is not None:
+                self.dropped += 1
+            if dropped is not item:
+                self._items.append(item)
+                self.max_depth = max(self.max_depth, len(self._items))
+                self._cond.notify_all()
+
+        if dropped is not None and callable(self.on_drop):
+            self.on_drop(dropped)
+        return dropped is not item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def __work(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._closed:
+                    self._cond.wait()
+                if not self._items:
+                    return
+                item = self._items.popleft()
+                self._cond.notify_all()
+
+            failed = False
+            try:
+                self.handler(item)
+            except Exception as e:
+                failed = True
+                print(f'Error in {threading.current_thread().name}: {e!r}')
+
+            with self._cond:
+                self.processed += 1
+                self.errors += failed